@@ -1,94 +1,1473 @@
 import math
-import ast
+import os
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
 
-import pygame
-import pygame.gfxdraw
+import numpy as np
+
+import fsaformat
 
 
 class StartError(Exception):
     pass
 
 
+class TestFileError(Exception):
+    def __init__(self, message, line):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+
+# Marks an empty entry in a compiled transition table
+NO_TRANSITION = -1
+# Marks an entry in a compiled transition table that has not been determined yet
+UNEXPLORED = -2
+
+# The symbol of a transition that can be taken without consuming any input
+EPSILON = "ε"
+
+# The symbols that can be put on transitions in the editor
+alphabet = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+# Character translation table sending every character without a symbol ID to the shared 'unknown' column
+class SymbolTranslation(dict):
+    def __init__(self, mapping, unknown):
+        super().__init__(mapping)
+        self.unknown = unknown
+
+    def __missing__(self, key):
+        return self.unknown
+
+
+class CompiledAutomaton:
+    """
+    A transition table of an automaton, with its states and symbols interned as integer IDs.
+
+    The automaton may be nondeterministic, so the table is that of the equivalent deterministic automaton,
+    whose states are sets of states of the original (stored as frozensets of IDs). It is built by subset construction,
+    one entry at a time, whenever a run reaches an entry that has not been determined yet
+    """
+    def __init__(self, automaton):
+        self.nfa_labels = []
+        self.nfa_ids = {}
+        for label in automaton.states:
+            self.intern_nfa(label)
+
+        # Only single characters can ever be matched by an input string
+        symbols = sorted({symbol for row in automaton.index.values() for symbol in row
+                          if len(symbol) == 1 and symbol != EPSILON})
+        self.alphabet = symbols
+        self.symbols = {symbol: i for i, symbol in enumerate(symbols)}
+        # The last column is shared by every character outside the alphabet, and never has a transition
+        self.width = len(symbols) + 1
+        self.translation = SymbolTranslation({ord(symbol): i for symbol, i in self.symbols.items()}, len(symbols))
+
+        # The targets of every state for every symbol, and of its epsilon transitions
+        moves = {}
+        epsilon = {}
+        for s, row in automaton.index.items():
+            s = self.intern_nfa(s)
+            for symbol, targets in row.items():
+                targets = [self.intern_nfa(e) for e in targets]
+                if symbol == EPSILON:
+                    epsilon[s] = targets
+                elif symbol in self.symbols:
+                    moves.setdefault(s, {})[self.symbols[symbol]] = targets
+
+        # The states reachable from every state through epsilon transitions alone
+        self.closures = []
+        for s in range(len(self.nfa_labels)):
+            if s not in epsilon:
+                self.closures.append(frozenset((s,)))
+                continue
+
+            closure = {s}
+            todo = [s]
+            while todo:
+                for e in epsilon.get(todo.pop(), ()):
+                    if e not in closure:
+                        closure.add(e)
+                        todo.append(e)
+            self.closures.append(frozenset(closure))
+
+        # The epsilon-closed targets of every state, per symbol ID
+        self.moves = []
+        for s in range(len(self.nfa_labels)):
+            row = {}
+            for symbol, targets in moves.get(s, {}).items():
+                # A single target shares its closure instead of building an equal set
+                row[symbol] = self.closures[targets[0]] if len(targets) == 1 else \
+                    frozenset().union(*[self.closures[e] for e in targets])
+            self.moves.append(row)
+
+        self.accepting_states = frozenset(self.nfa_ids[label] for label in automaton.acceptors if label in self.nfa_ids)
+
+        # The deterministic states found so far
+        self.labels = []
+        self.sets = []
+        self.ids = {}
+        self.accepting = bytearray()
+        self.table = array('i')
+        self.blank_row = array('i', [UNEXPLORED]) * (self.width - 1) + array('i', [NO_TRANSITION])
+
+        start = self.nfa_ids.get(automaton.start)
+        self.start = None if start is None else self.intern(self.closures[start])
+
+        self.arrays = None
+        self.bytes_translation = None
+
+    def intern_nfa(self, label):
+        """
+        Get the ID of a state label of the original automaton, assigning the next free ID if it has none yet
+
+        :param label: the state label
+        :return: the state ID
+        """
+        if label not in self.nfa_ids:
+            self.nfa_ids[label] = len(self.nfa_labels)
+            self.nfa_labels.append(label)
+        return self.nfa_ids[label]
+
+    def intern(self, states):
+        """
+        Get the ID of the deterministic state for a set of states, adding a row to the table if it is new
+
+        :param states: the frozenset of state IDs of the original automaton
+        :return: the deterministic state ID
+        """
+        if states not in self.ids:
+            self.ids[states] = len(self.labels)
+            self.sets.append(states)
+            members = self.state_members(len(self.labels))
+            self.labels.append(members[0] if len(members) == 1 else "{" + ",".join(members) + "}")
+            self.accepting.append(0 if self.accepting_states.isdisjoint(states) else 1)
+            self.table.extend(self.blank_row)
+        return self.ids[states]
+
+    def state_members(self, current):
+        """
+        :param current: the deterministic state ID
+        :return: the labels of the states of the original automaton making up the deterministic state
+        """
+        return [self.nfa_labels[s] for s in sorted(self.sets[current])]
+
+    def expand(self, current, symbol):
+        """
+        Determine a single entry of the transition table by subset construction
+
+        :param current: the deterministic state ID
+        :param symbol: the symbol ID
+        :return: the deterministic state reached, or NO_TRANSITION if no state is reached
+        """
+        states = self.sets[current]
+        if len(states) == 1:
+            for s in states:
+                states = self.moves[s].get(symbol)
+        else:
+            states = frozenset().union(*[self.moves[s].get(symbol, ()) for s in states])
+
+        nextstate = NO_TRANSITION if not states else self.intern(states)
+        self.table[current * self.width + symbol] = nextstate
+        return nextstate
+
+    def explore(self):
+        """
+        Determine every entry of the transition table that can be reached from the starting state
+        """
+        if self.start is None:
+            return
+
+        current = 0
+        while current < len(self.labels):
+            base = current * self.width
+            for symbol in range(self.width - 1):
+                if self.table[base + symbol] == UNEXPLORED:
+                    self.expand(current, symbol)
+            current += 1
+
+    def next_state(self, current, symbol):
+        """
+        Follow a single transition, treating a missing one as leading to NO_TRANSITION, which has no transitions itself
+
+        :param current: the deterministic state ID, or NO_TRANSITION
+        :param symbol: the symbol, as a character
+        :return: the deterministic state reached, or NO_TRANSITION
+        """
+        if current == NO_TRANSITION or (symbol := self.symbols.get(symbol)) is None:
+            return NO_TRANSITION
+
+        nextstate = self.table[current * self.width + symbol]
+        if nextstate == UNEXPLORED:
+            nextstate = self.expand(current, symbol)
+        return nextstate
+
+    def accepts(self, current):
+        """
+        Check whether a deterministic state is accepting
+
+        :param current: the deterministic state ID, or NO_TRANSITION
+        :return: True if the state is accepting
+        """
+        return current != NO_TRANSITION and self.accepting[current] == 1
+
+    def encode(self, string):
+        """
+        Translate a string into a sequence of symbol IDs
+
+        :param string: the input string
+        :return: a bytes object, or an array when there are too many symbols to fit in a byte
+        """
+        translated = string.translate(self.translation)
+        if self.width <= 256:
+            return translated.encode('latin-1')
+        return array('I', map(ord, translated))
+
+    def encode_bytes(self, data):
+        """
+        Translate bytes into a sequence of symbol IDs, reading every byte as a Latin-1 character
+
+        :param data: a bytes-like object
+        :return: a bytes object, or an array when there are too many symbols to fit in a byte
+        """
+        if self.width > 256:
+            return self.encode(str(data, 'latin-1'))
+
+        if self.bytes_translation is None:
+            self.bytes_translation = bytes(self.translation[b] for b in range(256))
+        return bytes(data).translate(self.bytes_translation)
+
+    def walk(self, current, symbols):
+        """
+        Follow the transition table from a state through a sequence of symbol IDs
+
+        :param current: the ID of the state to start from
+        :param symbols: the symbol IDs
+        :return: the ID of the state reached, and whether a missing transition stopped the walk early
+        """
+        table = self.table
+        width = self.width
+
+        for symbol in symbols:
+            nextstate = table[current * width + symbol]
+            if nextstate < 0:
+                if nextstate == UNEXPLORED:
+                    nextstate = self.expand(current, symbol)
+                if nextstate == NO_TRANSITION:
+                    return current, True
+            current = nextstate
+        return current, False
+
+    def trace(self, current, symbols):
+        """
+        Like walk(), but record the ID of every state visited along the way
+
+        :param current: the ID of the state to start from
+        :param symbols: the symbol IDs
+        :return: an array of the visited state IDs, starting with 'current'
+        """
+        table = self.table
+        width = self.width
+        states = array('I', [current])
+
+        for symbol in symbols:
+            nextstate = table[current * width + symbol]
+            if nextstate < 0:
+                if nextstate == UNEXPLORED:
+                    nextstate = self.expand(current, symbol)
+                if nextstate == NO_TRANSITION:
+                    break
+            states.append(nextstate)
+            current = nextstate
+        return states
+
+    def numpy_tables(self):
+        """
+        Get NumPy versions of the complete transition table and the accepting states.
+        Missing transitions lead to an extra dead state, which is the last row of the table and never accepts
+
+        :return: the (states + 1) x alphabet transition table, a boolean array of accepting states,
+                 and the ID of the dead state
+        """
+        if self.arrays is None:
+            self.explore()
+            dead = len(self.labels)
+            table = np.frombuffer(self.table, dtype=np.intc).reshape(dead, self.width)
+            table = np.vstack([np.where(table == NO_TRANSITION, dead, table), np.full((1, self.width), dead)])
+            accepting = np.append(np.frombuffer(self.accepting, dtype=np.uint8).astype(bool), False)
+            self.arrays = table.astype(np.intp), accepting, dead
+        return self.arrays
+
+    def run_batch(self, strings):
+        """
+        Run many strings at once, advancing all of them in lock-step through the transition table
+
+        :param strings: the input strings
+        :return: a boolean array telling which strings were accepted,
+                 and an array of the final state IDs (NO_TRANSITION for strings that ran into a missing transition)
+        """
+        if self.start is None:
+            raise StartError
+        table, accepting, dead = self.numpy_tables()
+
+        strings = list(strings)
+        lengths = np.fromiter(map(len, strings), dtype=np.intp, count=len(strings))
+        encoded = self.encode("".join(strings))
+        symbols = np.frombuffer(encoded, dtype=np.uint8 if isinstance(encoded, bytes) else np.uintc)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.intp)
+
+        # Order the strings from longest to shortest, so the ones that still have symbols left are always a prefix
+        order = np.argsort(-lengths, kind='stable')
+        remaining = lengths[order]
+        positions = offsets[order]
+        current = np.full(len(strings), self.start, dtype=np.intp)
+
+        # Number of strings that are longer than each step
+        steps = np.arange(remaining[0] if len(strings) else 0)
+        active = len(strings) - np.searchsorted(remaining[::-1], steps, 'right')
+        for step, count in enumerate(active):
+            if dead == NO_TRANSITION:
+                # Without a dead row, only the strings that haven't run into a missing transition move on
+                moving = np.flatnonzero(current[:count] != NO_TRANSITION)
+                current[moving] = table[current[moving], symbols[positions[moving] + step]]
+            else:
+                current[:count] = table[current[:count], symbols[positions[:count] + step]]
+
+        final = np.empty_like(current)
+        final[order] = current
+        final[final == dead] = NO_TRANSITION
+        accepted = np.zeros(len(final), dtype=bool)
+        reached = final != NO_TRANSITION
+        accepted[reached] = accepting[final[reached]]
+        return accepted, final
+
+
+class MappedAutomaton(CompiledAutomaton):
+    """
+    A compiled automaton whose complete transition table is used straight from a memory-mapped binary file.
+    Labels are only decoded when they are needed, so opening even a very large file is instant
+    """
+    def __init__(self, binary):
+        self.binary = binary
+        self.alphabet = list(binary.symbol_labels())
+        self.symbols = {symbol: i for i, symbol in enumerate(self.alphabet)}
+        self.width = len(self.alphabet) + 1
+        self.translation = SymbolTranslation({ord(symbol): i for symbol, i in self.symbols.items()}, len(self.alphabet))
+
+        self.labels = binary.dfa_labels()
+        self.accepting = binary.accepting
+        self.table = binary.table
+        self.start = None if binary.dfa_start == fsaformat.NO_START else binary.dfa_start
+
+        self.states = binary.state_labels()
+        self.arrays = None
+        self.bytes_translation = None
+
+    def state_members(self, current):
+        offsets = self.binary.member_offsets
+        return [self.states[s] for s in self.binary.members[offsets[current]:offsets[current + 1]]]
+
+    def expand(self, current, symbol):
+        raise ValueError("The transition table of a binary automaton file is always complete")
+
+    def explore(self):
+        # The table is complete already
+        pass
+
+    def numpy_tables(self):
+        """
+        Get NumPy views of the mapped transition table and accepting states, without copying them,
+        so every process running strings through the same file shares the operating system's cached copy.
+        Missing transitions are left as NO_TRANSITION, which stands in for the dead state
+
+        :return: the states x alphabet transition table, a boolean array of accepting states,
+                 and NO_TRANSITION as the ID of the dead state
+        """
+        if self.arrays is None:
+            table = np.frombuffer(self.table, dtype=np.intc).reshape(len(self.labels), self.width)
+            accepting = np.frombuffer(self.accepting, dtype=np.uint8).view(bool)
+            self.arrays = table, accepting, NO_TRANSITION
+        return self.arrays
+
+
+def open_binary(path):
+    """
+    Open the transition table of a binary automaton file, for running strings without loading the whole automaton
+
+    :param path: the path of the .fsab file
+    :return: the compiled automaton
+    """
+    return MappedAutomaton(fsaformat.BinaryFile(path))
+
+
+class Recognizer:
+    """
+    Runs input through a compiled automaton as it arrives, keeping nothing but the current state.
+    Strings are fed as characters, and bytes-like objects (including mmap objects) as Latin-1 characters:
+
+        recognizer = automaton.stream()
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            recognizer.feed(m)
+        end, result = recognizer.result()
+    """
+
+    # The number of bytes translated at once, which bounds the memory used when feeding large buffers
+    chunk_size = 1 << 20
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.current = compiled.start
+        self.stopped = False
+
+    def feed(self, chunk):
+        """
+        Consume the next piece of input
+
+        :param chunk: a string or bytes-like object
+        """
+        # Once a transition is missing the result can no longer change
+        if self.stopped:
+            return
+
+        if isinstance(chunk, str):
+            self.current, self.stopped = self.compiled.walk(self.current, self.compiled.encode(chunk))
+            return
+
+        with memoryview(chunk) as view, view.cast('B') as data:
+            for i in range(0, len(data), self.chunk_size):
+                symbols = self.compiled.encode_bytes(data[i:i + self.chunk_size])
+                self.current, self.stopped = self.compiled.walk(self.current, symbols)
+                if self.stopped:
+                    return
+
+    def result(self):
+        """
+        Get the outcome of the input consumed so far
+
+        :return: the current state and whether the input so far is accepted
+        """
+        accepted = self.compiled.accepting[self.current] and not self.stopped
+        return self.compiled.labels[self.current], "Accepted" if accepted else "Declined"
+
+
+class Steps:
+    """
+    The transitions taken by running a string through a compiled automaton, as (from, to) tuples of state labels.
+    The string is only walked as far as the steps are iterated over, and result() walks the rest without keeping them
+    """
+    def __init__(self, automaton, compiled, symbols):
+        """
+        :param automaton: the automaton, whose current state is set once the whole string has been walked
+        :param compiled: its compiled automaton
+        :param symbols: the symbol IDs of the string
+        """
+        self.automaton = automaton
+        self.compiled = compiled
+        self.symbols = iter(symbols)
+        self.current = compiled.start
+        self.stopped = False
+
+    def __iter__(self):
+        table = self.compiled.table
+        width = self.compiled.width
+        labels = self.compiled.labels
+
+        for symbol in self.symbols:
+            nextstate = table[self.current * width + symbol]
+            if nextstate < 0:
+                if nextstate == UNEXPLORED:
+                    nextstate = self.compiled.expand(self.current, symbol)
+                if nextstate == NO_TRANSITION:
+                    self.stopped = True
+                    return
+            # Move on before yielding, so a step that was handed out is never taken again
+            previous, self.current = self.current, nextstate
+            yield labels[previous], labels[nextstate]
+
+    def result(self):
+        """
+        Walk the rest of the string
+
+        :return: the final state and whether the string was accepted
+        """
+        if not self.stopped:
+            self.current, self.stopped = self.compiled.walk(self.current, self.symbols)
+
+        self.automaton.current = self.compiled.labels[self.current]
+        accepted = self.compiled.accepting[self.current] and not self.stopped
+        return self.automaton.current, "Accepted" if accepted else "Declined"
+
+
+class Trace:
+    """
+    A string run through an automaton, keeping only the compiled state reached at every step,
+    so the states and transitions of any step are looked up directly instead of running the string again
+    """
+    def __init__(self, automaton, string):
+        """
+        :param automaton: the automaton
+        :param string: the string to run
+        """
+        self.states, (self.end, self.result) = automaton.run(string, trace="compact")
+        self.automaton = automaton
+        self.compiled = automaton.compiled
+        self.string = string
+        # For every state the transitions leaving it and the symbols they are taken on, gathered when first needed
+        self.outgoing = None
+
+    def __len__(self):
+        """
+        :return: the number of steps taken, which is less than the length of the string if a transition was missing
+        """
+        return len(self.states) - 1
+
+    def stale(self):
+        """
+        :return: True if the transitions of the automaton changed since the string was run
+        """
+        return self.automaton.compiled is not self.compiled
+
+    def states_at(self, step):
+        """
+        :param step: the number of symbols read
+        :return: the labels of the states the automaton is in after reading them
+        """
+        return self.compiled.state_members(self.states[step])
+
+    def transitions_at(self, step):
+        """
+        :param step: the number of symbols read
+        :return: the keys of the transitions taken on reading the last of them
+        """
+        if step == 0:
+            return []
+        if self.outgoing is None:
+            self.outgoing = {}
+            for s, via, e in self.automaton.transitions:
+                self.outgoing.setdefault(s, []).append(((s, via, e), via.split(',')))
+
+        symbol = self.string[step - 1]
+        return [key for s in self.states_at(step - 1) for key, symbols in self.outgoing.get(s, ()) if symbol in symbols]
+
+
+class TestSuite:
+    """
+    A list of test strings with the results they are expected to give, checked against an automaton as it is edited.
+
+    The result of every string is remembered, together with the states its run went through and the symbols it read
+    in them. After an edit, only the strings that went through a state whose transitions or accepting changed,
+    and read a changed symbol there, are run again
+    """
+    def __init__(self):
+        # (string, expected result) tuples, where the result is "Accepted" or "Declined"
+        self.cases = []
+        # For every string, the positions of the cases testing it
+        self.positions = {}
+        # The result of every string that has been run, and the strings still to be run
+        self.results = {}
+        self.pending = set()
+        # The positions of the cases whose string was run and gave another result than expected
+        self.failing = set()
+
+        # For every (state, symbol), the strings that read the symbol while in the state,
+        # and for every state, the strings that went through it at all
+        self.reading = {}
+        self.visiting = {}
+        # For every string that has been run, the keys it was put under in the above, to take it out again
+        self.touched = {}
+
+        # The automaton the results are for, the version and compiled table of it that were last looked at,
+        # and what its start, acceptors and transitions were then
+        self.automaton = None
+        self.seen = None
+        self.compiled = None
+        self.start = None
+        self.acceptors = frozenset()
+        self.rows = {}
+        # Counts every change to the cases and results, so others can tell whether they changed
+        self.version = 0
+
+    def add(self, string, expected):
+        """
+        Add a case, which is run the next time pending strings are run unless its string already has a result
+
+        :param string: the test string
+        :param expected: the result the string should give, "Accepted" or "Declined"
+        """
+        position = len(self.cases)
+        self.cases.append((string, expected))
+        self.positions.setdefault(string, []).append(position)
+        if string in self.results:
+            if self.results[string] != expected:
+                self.failing.add(position)
+        else:
+            self.pending.add(string)
+        self.version += 1
+
+    def clear(self):
+        """
+        Remove every case
+        """
+        self.cases = []
+        self.positions = {}
+        self.results = {}
+        self.pending = set()
+        self.failing = set()
+        self.reading = {}
+        self.visiting = {}
+        self.touched = {}
+        self.version += 1
+
+    def load(self, path):
+        """
+        Add the cases in a file, with a case on every line: '+' for a string that should be accepted or '-'
+        for one that should be declined, followed by the string itself. Empty lines are skipped.
+        Nothing is added if any other line is found
+
+        :param path: the path of the file
+        :raises TestFileError: for a line starting with anything else
+        """
+        cases = []
+        with open(path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                line = line.rstrip("\r\n")
+                if not line:
+                    continue
+                if line[0] not in "+-":
+                    raise TestFileError("expected '+' or '-' before the string", number)
+                cases.append((line[1:], "Accepted" if line[0] == "+" else "Declined"))
+
+        for string, expected in cases:
+            self.add(string, expected)
+
+    def summary(self):
+        """
+        :return: the number of cases that passed, failed and are still to be run
+        """
+        waiting = sum(len(self.positions[string]) for string in self.pending)
+        return len(self.cases) - len(self.failing) - waiting, len(self.failing), waiting
+
+    def update(self, automaton):
+        """
+        Find out what changed in the automaton since it was last looked at, and mark the strings whose results
+        may have changed by it as pending. A different automaton than last time has every string run again
+
+        :param automaton: the automaton the cases are tested on
+        """
+        # Without cases there are no results to keep up to date, so the automaton is only looked at once there are
+        if not self.cases:
+            self.automaton = None
+            return
+        if automaton is self.automaton and automaton.version == self.seen:
+            return
+        self.seen = automaton.version
+        # Moving states and bending transitions keep the compiled table, and never change a result
+        if automaton is self.automaton and automaton.compiled is not None and automaton.compiled is self.compiled:
+            return
+
+        rows = {s: {symbol: frozenset(targets) for symbol, targets in row.items()} for s, row in automaton.index.items()}
+        acceptors = frozenset(automaton.acceptors)
+
+        if automaton is not self.automaton or automaton.start != self.start:
+            affected = set(self.results)
+        else:
+            affected = set()
+            for s in rows.keys() | self.rows.keys():
+                old, new = self.rows.get(s, {}), rows.get(s, {})
+                if old == new:
+                    continue
+                for symbol in old.keys() | new.keys():
+                    if old.get(symbol) != new.get(symbol):
+                        # Epsilon transitions are followed whatever symbol is read
+                        affected |= self.visiting.get(s, set()) if symbol == EPSILON else \
+                            self.reading.get((s, symbol), set())
+            for s in acceptors ^ self.acceptors:
+                affected |= self.visiting.get(s, set())
+
+        for string in affected:
+            self.forget(string)
+        self.pending |= affected
+
+        self.automaton = automaton
+        self.compiled = automaton.compile()
+        self.start = automaton.start
+        self.acceptors = acceptors
+        self.rows = rows
+        if affected:
+            self.version += 1
+
+    def forget(self, string):
+        """
+        Drop the result of a string, and take it out of the states and symbols it was found under
+        """
+        del self.results[string]
+        pairs, states = self.touched.pop(string)
+        for key in pairs:
+            self.reading[key].discard(string)
+        for s in states:
+            self.visiting[s].discard(string)
+        for position in self.positions[string]:
+            self.failing.discard(position)
+
+    def run(self, deadline=None):
+        """
+        Run the pending strings through the automaton last looked at by update, which has to be called first
+        so the results are for the automaton as it is now
+
+        :param deadline: a time.monotonic() time after which the remaining strings are left for a later call
+        :return: True if there are strings left to run
+        """
+        if not self.pending:
+            return False
+
+        compiled = self.automaton.compile()
+        members = {}
+        while self.pending and (deadline is None or time.monotonic() < deadline):
+            string = self.pending.pop()
+            try:
+                states, (_, result) = self.automaton.run(string, trace="compact")
+            except StartError:
+                states, result = (), "No Start"
+
+            # The states of the original automaton that every deterministic state the run went through is made of
+            passed = set(states)
+            for current in passed:
+                if current not in members:
+                    members[current] = compiled.state_members(current)
+            pairs = {(s, symbol) for current, symbol in set(zip(states, string)) for s in members[current]}
+            visited = {s for current in passed for s in members[current]}
+
+            for key in pairs:
+                self.reading.setdefault(key, set()).add(string)
+            for s in visited:
+                self.visiting.setdefault(s, set()).add(string)
+            self.touched[string] = (pairs, visited)
+
+            self.results[string] = result
+            for position in self.positions[string]:
+                if self.cases[position][1] != result:
+                    self.failing.add(position)
+
+        self.version += 1
+        return bool(self.pending)
+
+
 class Automaton:
     def __init__(self):
         self.states = {}
         self.transitions = {}
+        # For every state and symbol, the states it leads to and the number of transitions leading to each of them
+        self.index = {}
         self.acceptors = []
         self.start = None
         self.current = None
+        self.compiled = None
+        # Counts every change, so others can tell whether the automaton changed since they last looked at it
+        self.version = 0
+
+    def copy(self):
+        """
+        Create an independent copy of this automaton, which shares the compiled table until either is changed
+
+        :return: the copy
+        """
+        automaton = Automaton()
+        automaton.states = dict(self.states)
+        automaton.transitions = dict(self.transitions)
+        automaton.index = {s: {symbol: dict(targets) for symbol, targets in row.items()}
+                           for s, row in self.index.items()}
+        automaton.acceptors = list(self.acceptors)
+        automaton.start = self.start
+        automaton.current = self.current
+        automaton.compiled = self.compiled
+        automaton.version = self.version
+        return automaton
+
+    # Discard everything derived from the structure of the automaton after it has been changed
+    def modified(self):
+        self.compiled = None
+        self.version += 1
+
+    # Move a state, which only changes the layout and so keeps the compiled table
+    def move_state(self, label, pos):
+        self.states[label] = pos
+        self.version += 1
+
+    # Change the force vector curving a transition, which keeps the compiled table as well
+    def bend_transition(self, transition, force_vector):
+        self.transitions[transition] = force_vector
+        self.version += 1
+
+    # Add a transition to the symbol lookup of its starting state
+    def index_transition(self, start, end, via):
+        row = self.index.setdefault(start, {})
+        for symbol in via.split(','):
+            targets = row.setdefault(symbol, {})
+            targets[end] = targets.get(end, 0) + 1
+
+    # Take a transition out of the symbol lookup of its starting state, keeping targets other transitions lead to
+    def unindex_transition(self, start, end, via):
+        row = self.index[start]
+        for symbol in via.split(','):
+            targets = row[symbol]
+            targets[end] -= 1
+            if not targets[end]:
+                del targets[end]
+                if not targets:
+                    del row[symbol]
+        if not row:
+            del self.index[start]
+
+    # Rebuild the symbol lookup of every state
+    def index_all(self):
+        self.index = {}
+        for s, v, e in self.transitions:
+            self.index_transition(s, e, v)
 
     def add_transition(self, start, end, via, force_vector=(0, 0)):
-        self.transitions[(start, via)] = (end, force_vector)
+        if (start, via, end) not in self.transitions:
+            self.index_transition(start, end, via)
+        self.transitions[(start, via, end)] = force_vector
+        self.modified()
 
     def remove_transition(self, key):
         del self.transitions[key]
+        start, via, end = key
+        self.unindex_transition(start, end, via)
+        self.modified()
 
     def add_state(self, label, pos):
         self.states[label] = pos
+        self.modified()
 
     def remove_state(self, label):
         del self.states[label]
 
-        self.transitions = {(s, v): (e, m) for (s, v), (e, m) in self.transitions.items() if label not in [s, e]}
+        self.transitions = {(s, v, e): m for (s, v, e), m in self.transitions.items() if label not in [s, e]}
+        self.index_all()
         self.acceptors = [a for a in self.acceptors if a != label]
         if self.start == label:
             self.start = None
+        self.modified()
 
     def add_acceptor(self, label):
         self.acceptors.append(label)
+        self.modified()
 
     def remove_acceptor(self, label):
         self.acceptors.remove(label)
+        self.modified()
 
     def set_start(self, start):
         self.start = start
         self.current = start
+        self.modified()
+
+    def save(self, path, progress=None):
+        """
+        Save this automaton to a .fsa file. The file is written in chunks to a temporary file,
+        which only replaces the original once it is complete
+
+        :param path: the path of the file
+        :param progress: an optional function called with the fraction written after every chunk
+        """
+        with fsaformat.replacing(path, "w", encoding="utf-8") as f:
+            fsaformat.write(self, f, progress)
+
+    def load(self, path, progress=None):
+        """
+        Load an automaton from a .fsa file, which is parsed in chunks as it is read
+
+        :param path: the path of the file
+        :param progress: an optional function called with the fraction read after every chunk
+        """
+        with open(path, encoding="utf-8") as f:
+            size = os.fstat(f.fileno()).st_size
+
+            def read(characters):
+                progress(min(characters / size, 1))
+
+            self.states, self.transitions, self.acceptors, self.start = \
+                fsaformat.parse(f, read if progress is not None and size else None)
+        self.index_all()
+        self.current = self.start
+        self.modified()
+
+    def save_binary(self, path):
+        """
+        Save this automaton and its complete transition table to a binary .fsab file,
+        through a temporary file which only replaces the original once it is complete
+
+        :param path: the path of the file
+        """
+        with fsaformat.replacing(path, "wb") as f:
+            fsaformat.write_binary(self, f)
+
+    def load_binary(self, path):
+        """
+        Load an automaton from a binary .fsab file.
+        The file is memory-mapped, and its transition table is used as the compiled table without copying
+
+        :param path: the path of the file
+        """
+        binary = fsaformat.BinaryFile(path)
+
+        def whole(x):
+            return int(x) if x.is_integer() else x
+
+        labels = list(binary.state_labels())
+        positions = binary.positions.tolist()
+        self.states = {label: (whole(positions[2 * i]), whole(positions[2 * i + 1])) for i, label in enumerate(labels)}
+
+        vectors = binary.vectors.tolist()
+        ends = binary.ends.tolist()
+        self.transitions = {(labels[ends[2 * i]], v, labels[ends[2 * i + 1]]): (whole(vectors[2 * i]),
+                                                                                 whole(vectors[2 * i + 1]))
+                            for i, v in enumerate(binary.transition_labels())}
+        self.index_all()
+
+        self.acceptors = [labels[a] for a in binary.acceptor_states]
+        self.start = None if binary.start == fsaformat.NO_START else labels[binary.start]
+        self.current = self.start
+        self.modified()
+        self.compiled = MappedAutomaton(binary)
 
-    def save(self):
-        states = ";".join([f"{lbl},{pos}" for lbl, pos in self.states.items()])
-        transitions = ";".join([f"{s}_{v}_{e}_{m}" for (s, v), (e, m) in self.transitions.items()])
-        acceptors = ",".join(self.acceptors)
-        start = self.start if self.start is not None else ""
+    # Get the states reached from the given state via the given symbol, or None if there is no such transition
+    def transition(self, label, letter):
+        row = self.index.get(label)
+        if row is None or letter not in row:
+            return None
+        return list(row[letter])
+
+    def run(self, string, trace="list"):
+        """
+        Run a string through the automaton
+
+        :param string: the input string
+        :param trace: how the steps taken are returned:
+                      "list" - a list of (from, to) state label tuples
+                      "compact" - an array('I') of the IDs of the visited states in the compiled automaton,
+                                  starting with the starting state
+                      "lazy" - an iterator of (from, to) state label tuples, which only walks the string as far as
+                               it is iterated over, with the outcome replaced by a function that walks the rest
+                      None - no steps at all
+        :return: the steps, and the final state and whether the string was accepted
+        """
+        if trace is None:
+            return None, self.run_compiled(string)
+
+        compiled = self.compile()
+        if compiled.start is None:
+            raise StartError
 
-        return [states, transitions, acceptors, start]
+        if trace == "compact":
+            states = compiled.trace(compiled.start, compiled.encode(string))
+            current = states[-1]
+            stopped = len(states) <= len(string)
+        elif trace == "lazy":
+            steps = Steps(self, compiled, compiled.encode(string))
+            return steps, steps.result
+        elif trace == "list":
+            steps = Steps(self, compiled, compiled.encode(string))
+            return list(steps), steps.result()
+        else:
+            raise ValueError(f"Unknown trace mode: {trace}")
+
+        self.current = compiled.labels[current]
+        return states, (self.current, "Accepted" if compiled.accepting[current] and not stopped else "Declined")
+
+    def compile(self):
+        """
+        Get the compiled transition table of this automaton, building it if it is not cached
+
+        :return: the compiled automaton
+        """
+        if self.compiled is None:
+            self.compiled = CompiledAutomaton(self)
+        return self.compiled
+
+    def run_compiled(self, string):
+        """
+        Run a string through the compiled transition table, without recording the steps taken
+
+        :param string: the input string
+        :return: the final state and whether the string was accepted
+        """
+        compiled = self.compile()
+        if compiled.start is None:
+            raise StartError
 
-    def load(self, lines):
-        states, transitions, acceptors, start = [line.strip() for line in lines]
-        states = [s.split(',', 1) for s in states.split(';')]
-        self.states = {k: ast.literal_eval(v) for k, v in states}
+        current, stopped = compiled.walk(compiled.start, compiled.encode(string))
 
-        transitions = [t.split('_') for t in transitions.split(';')]
-        self.transitions = {(s, v): (e, ast.literal_eval(m)) for s, v, e, m in transitions}
+        self.current = compiled.labels[current]
+        return self.current, "Accepted" if compiled.accepting[current] and not stopped else "Declined"
 
-        self.acceptors = acceptors.split(',')
-        self.start = start
-        self.current = start
+    def stream(self):
+        """
+        Create a recognizer that is fed the input piece by piece, for input that is too large to keep in memory
 
-    def transition(self, label, letter):
-        for (s, v) in self.transitions:
-            if s == label and letter in v:
-                return self.transitions[(label, v)]
-        return None
+        :return: the recognizer
+        """
+        compiled = self.compile()
+        if compiled.start is None:
+            raise StartError
 
-    def run(self, string):
-        if self.start is None:
+        return Recognizer(compiled)
+
+    def run_batch(self, strings):
+        """
+        Run many strings at once, advancing all of them in lock-step through the compiled transition table
+
+        :param strings: the input strings
+        :return: a boolean array telling which strings were accepted,
+                 and an array of the final state IDs (NO_TRANSITION for strings that ran into a missing transition)
+        """
+        compiled = self.compile()
+        if compiled.start is None:
             raise StartError
 
-        self.current = self.start
-        steps = []
+        return compiled.run_batch(strings)
+
+    def minimize(self):
+        """
+        Create the minimal deterministic automaton accepting the same strings as this one.
+        Unreachable states are dropped, equivalent states are merged with Hopcroft's algorithm,
+        and every merged state is positioned at the average position of the states it was made from
+
+        :return: the minimized automaton
+        """
+        compiled = self.compile()
+        if compiled.start is None:
+            raise StartError
 
-        for c in string:
-            nextstate = self.transition(self.current, c)
-            if nextstate is not None:
-                steps.append((self.current, nextstate[0]))
-                self.current = nextstate[0]
+        # Only states reachable from the starting state are ever added to the compiled table
+        compiled.explore()
+        n = len(compiled.labels)
+        k = compiled.width - 1
+
+        # Complete the table with a sink state, so that every state has a transition for every symbol
+        sink = n
+        delta = [[sink if e == NO_TRANSITION else e for e in compiled.table[q * compiled.width:q * compiled.width + k]]
+                 for q in range(n)]
+        delta.append([sink] * k)
+
+        # The states leading into every state, per symbol
+        inverse = [[[] for _ in range(n + 1)] for _ in range(k)]
+        for q, row in enumerate(delta):
+            for a, e in enumerate(row):
+                inverse[a][e].append(q)
+
+        # Start with the accepting and rejecting states as the two blocks of the partition
+        accepting = {q for q in range(n) if compiled.accepting[q]}
+        blocks = [block for block in (accepting, set(range(n + 1)) - accepting) if block]
+        block_of = [0] * (n + 1)
+        for b, block in enumerate(blocks):
+            for q in block:
+                block_of[q] = b
+
+        # Splitters still to be processed, starting with the smaller block for every symbol
+        smallest = min(range(len(blocks)), key=lambda b: len(blocks[b]))
+        waiting = {(smallest, a) for a in range(k)}
+        while waiting:
+            splitter, a = waiting.pop()
+
+            # Group the states leading into the splitter by the block they are in
+            touched = {}
+            for e in blocks[splitter]:
+                for q in inverse[a][e]:
+                    touched.setdefault(block_of[q], set()).add(q)
+
+            for b, states in touched.items():
+                if len(states) == len(blocks[b]):
+                    continue
+
+                # Split the block in place, keeping the larger half under the old ID,
+                # so only the states of the smaller half are ever moved
+                rest = blocks[b]
+                rest.difference_update(states)
+                if len(states) > len(rest):
+                    blocks[b], states = states, rest
+                blocks.append(states)
+                new = len(blocks) - 1
+                for q in states:
+                    block_of[q] = new
+
+                # The new block is the smaller half, which is the one to add whether or not the old one is waiting
+                for c in range(k):
+                    waiting.add((new, c))
+
+        # Number the blocks in order of discovery, leaving out the block of states that can never accept
+        # (unless the starting state is one of them, in which case the automaton accepts nothing at all)
+        dead = block_of[sink]
+        order = {}
+        for q in range(n):
+            if block_of[q] != dead or q == compiled.start:
+                order.setdefault(block_of[q], len(order))
+        representatives = {}
+        members = [[] for _ in order]
+        for q in range(n):
+            if block_of[q] in order:
+                representatives.setdefault(order[block_of[q]], q)
+                members[order[block_of[q]]].append(q)
+
+        edges = [{compiled.alphabet[a]: order[block_of[e]]
+                  for a, e in enumerate(delta[representatives[b]]) if block_of[e] != dead} for b in range(len(order))]
+
+        # Keep the original labels of states that were not merged with anything, and number the rest
+        labels = []
+        positions = []
+        for b in range(len(order)):
+            originals = [label for q in members[b] for label in compiled.state_members(q)]
+            labels.append(originals[0] if len(originals) == 1 else None)
+            points = [self.states[label] for label in originals if label in self.states]
+            if points:
+                positions.append((round(sum(x for x, _ in points) / len(points)),
+                                  round(sum(y for _, y in points) / len(points))))
             else:
-                return steps, (self.current, "Declined")
+                positions.append((0, 0))
+
+        start = order[block_of[compiled.start]]
+        acceptors = [order[block_of[q]] for q in representatives.values() if compiled.accepting[q]]
+        return deterministic_automaton(labels, positions, edges, start, acceptors)
+
+    def equivalent(self, other):
+        """
+        Decide whether this automaton and another accept exactly the same strings, with the Hopcroft-Karp
+        algorithm: pairs of states that must be equivalent are merged with union-find while exploring both at once
+
+        :param other: the other automaton
+        :return: True and None if they are equivalent,
+                 otherwise False and a shortest string accepted by only one of the two
+        """
+        a, b = self.compile(), other.compile()
+        if a.start is None or b.start is None:
+            raise StartError
+        alphabet = sorted(set(a.alphabet) | set(b.alphabet))
+
+        # The states of the two automata are kept apart as (0, state) and (1, state)
+        parent = {}
+
+        def find(x):
+            while (up := parent.get(x, x)) != x:
+                parent[x] = parent.get(up, up)
+                x = up
+            return x
+
+        parent[(0, a.start)] = (1, b.start)
+        todo = deque([(a.start, b.start)])
+        while todo:
+            p, q = todo.popleft()
+            if a.accepts(p) != b.accepts(q):
+                return False, shortest_word(a, b, alphabet, lambda x, y: a.accepts(x) != b.accepts(y))
+
+            for symbol in alphabet:
+                p2, q2 = a.next_state(p, symbol), b.next_state(q, symbol)
+                x, y = find((0, p2)), find((1, q2))
+                if x != y:
+                    parent[x] = y
+                    todo.append((p2, q2))
+
+        return True, None
+
+    def subset_of(self, other):
+        """
+        Decide whether every string accepted by this automaton is also accepted by another
+
+        :param other: the other automaton
+        :return: True and None if it is, otherwise False and a shortest string accepted only by this automaton
+        """
+        a, b = self.compile(), other.compile()
+        if a.start is None or b.start is None:
+            raise StartError
+        alphabet = sorted(set(a.alphabet) | set(b.alphabet))
+
+        word = shortest_word(a, b, alphabet, lambda x, y: a.accepts(x) and not b.accepts(y))
+        return word is None, word
+
+    def product(self, other, accept):
+        """
+        Build the product of this automaton and another, which runs both on the same string at once.
+        Only pairs of states reachable from the pair of starting states are created, and pairs that can
+        never lead to an accepting pair (because a side without transitions left decides the outcome) are left out.
+        Once both sides have run out of transitions, the pair is kept as a sink looping on every symbol
+        if accept(False, False) holds
+
+        :param other: the other automaton
+        :param accept: a function deciding whether a pair is accepting, given whether each of its states is accepting
+        :return: the product automaton
+        """
+        a, b = self.compile(), other.compile()
+        if a.start is None or b.start is None:
+            raise StartError
+        alphabet = sorted(set(a.alphabet) | set(b.alphabet))
+
+        # Whether a pair can still be accepting once a side, or both, have run out of transitions
+        both_dead_alive = accept(False, False)
+        a_dead_alive = accept(False, True) or both_dead_alive
+        b_dead_alive = accept(True, False) or both_dead_alive
+
+        def alive(p, q):
+            if p == NO_TRANSITION and q == NO_TRANSITION:
+                return both_dead_alive
+            if p == NO_TRANSITION:
+                return a_dead_alive
+            return q != NO_TRANSITION or b_dead_alive
+
+        start = (a.start, b.start)
+        found = {start: 0}
+        todo = deque([start])
+        edges = []
+        acceptors = []
+        while todo:
+            p, q = pair = todo.popleft()
+            if accept(a.accepts(p), b.accepts(q)):
+                acceptors.append(found[pair])
+
+            row = {}
+            for symbol in alphabet:
+                nextpair = (a.next_state(p, symbol), b.next_state(q, symbol))
+                if not alive(*nextpair):
+                    continue
+                if nextpair not in found:
+                    found[nextpair] = len(found)
+                    todo.append(nextpair)
+                row[symbol] = found[nextpair]
+            edges.append(row)
+
+        return deterministic_automaton([None] * len(found), grid_positions(len(found)), edges, 0, acceptors)
+
+    def intersection(self, other):
+        """
+        :return: an automaton accepting the strings accepted by both this automaton and the other
+        """
+        return self.product(other, lambda x, y: x and y)
+
+    def union(self, other):
+        """
+        :return: an automaton accepting the strings accepted by this automaton, the other, or both
+        """
+        return self.product(other, lambda x, y: x or y)
+
+    def difference(self, other):
+        """
+        :return: an automaton accepting the strings accepted by this automaton but not by the other
+        """
+        return self.product(other, lambda x, y: x and not y)
+
+    def complement(self, alphabet=None):
+        """
+        Build an automaton accepting exactly the strings this automaton rejects.
+        Missing transitions lead to an accepting sink state, which has a transition for every symbol
+
+        :param alphabet: the symbols strings consist of, by default the symbols used by this automaton
+        :return: the complement automaton
+        """
+        if alphabet is None:
+            alphabet = self.compile().alphabet
+        return universal_automaton(alphabet).difference(self)
+
+
+def universal_automaton(alphabet):
+    """
+    :param alphabet: the symbols strings consist of
+    :return: an automaton accepting every string over the alphabet
+    """
+    automaton = Automaton()
+    automaton.add_state("q0", (100, 100))
+    if alphabet:
+        automaton.add_transition("q0", "q0", ",".join(alphabet), force_vector=(60, 0.5 * math.pi))
+    automaton.add_acceptor("q0")
+    automaton.set_start("q0")
+    return automaton
+
+
+def grid_positions(n, left=150, top=200, spacing=150, columns=7):
+    """
+    Place states in rows, for automata that were not drawn by hand
+
+    :param n: the number of states
+    :param left: the x coordinate of the first column
+    :param top: the y coordinate of the first row
+    :param spacing: the distance between neighbouring states
+    :param columns: the number of states per row
+    :return: a list of positions
+    """
+    return [(left + (i % columns) * spacing, top + (i // columns) * spacing) for i in range(n)]
+
+
+def layered_positions(automaton, left=150, top=200, spacing=150):
+    """
+    Place states in columns by their distance from the starting state, for automata that were not drawn by hand
+
+    :param automaton: the automaton
+    :param left: the x coordinate of the first column
+    :param top: the y coordinate of the first row
+    :param spacing: the distance between neighbouring columns and rows
+    :return: a dict from state label to position
+    """
+    depth = {}
+    if automaton.start in automaton.states:
+        depth[automaton.start] = 0
+        todo = deque([automaton.start])
+        while todo:
+            s = todo.popleft()
+            for targets in automaton.index.get(s, {}).values():
+                for e in targets:
+                    if e not in depth:
+                        depth[e] = depth[s] + 1
+                        todo.append(e)
+
+    # States that cannot be reached go in a column of their own after the others
+    last = max(depth.values(), default=-1) + 1
+    rows = {}
+    positions = {}
+    for label in automaton.states:
+        column = depth.get(label, last)
+        row = rows.get(column, 0)
+        rows[column] = row + 1
+        positions[label] = (left + column * spacing, top + row * spacing)
+    return positions
+
+
+def bend_transitions(automaton):
+    """
+    Curve the transitions of an automaton so they don't overlap: ones with a transition going back,
+    ones between the same two states, and ones that would otherwise pass straight through another state.
+    Loops point away from the other states their state is connected to, and several loops on a state are spread out
+    """
+    candidates = [key for key in automaton.transitions
+                  if key[0] != key[2] and key[0] in automaton.states and key[2] in automaton.states]
+
+    # The states in a grid by the area around them in which a transition counts as passing through them,
+    # so every transition is only measured against the states near it, until one of them is close enough
+    grid = Grid()
+    for label, (x, y) in automaton.states.items():
+        grid.insert(label, (x - 35, y - 35, x + 35, y + 35))
+    crossed = set()
+    for key in candidates:
+        s, _, e = key
+        start, end = automaton.states[s], automaton.states[e]
+        # A transition doesn't cross its own states
+        if any(point_to_segment(automaton.states[label], start, end) < 35
+               for label in grid.query_segment(start, end) if label not in (s, e)):
+            crossed.add(key)
+
+    # The transitions between every two states, and the states every state is connected to
+    between_states = {}
+    connected = {}
+    for key in automaton.transitions:
+        s, _, e = key
+        if s in automaton.states and e in automaton.states:
+            between_states.setdefault((s, e), []).append(key)
+            if s != e:
+                connected.setdefault(s, set()).add(e)
+                connected.setdefault(e, set()).add(s)
+
+    for (s, e), keys in between_states.items():
+        start, end = automaton.states[s], automaton.states[e]
+        if s == e:
+            # Point the loops away from the middle of the connected states, or down if that is where the state is
+            around = [automaton.states[c] for c in connected.get(s, ())]
+            dx = start[0] - sum(x for x, _ in around) / len(around) if around else 0
+            dy = start[1] - sum(y for _, y in around) / len(around) if around else 0
+            away = math.atan2(dy, dx) if math.hypot(dx, dy) >= 1 else 0.5 * math.pi
+            for i, key in enumerate(keys):
+                automaton.bend_transition(key, (60, away + (i - (len(keys) - 1) / 2) * math.pi / 3))
+            continue
+
+        for i, key in enumerate(keys):
+            if key in crossed:
+                distance = 40 + math.dist(start, end) / 8
+            elif (e, s) in between_states:
+                distance = 30
+            else:
+                distance = 0
+            # Every further transition between the same states curves further out
+            distance += 30 * i
+            automaton.bend_transition(key, (distance, 0.5) if distance else (0, 0))
+
+
+def shortest_word(a, b, alphabet, goal):
+    """
+    Search the pairs of states of two compiled automata, reachable by reading the same string, breadth first
+
+    :param a: the first compiled automaton
+    :param b: the second compiled automaton
+    :param alphabet: the symbols to follow
+    :param goal: a function telling whether a pair of deterministic states is the one searched for
+    :return: a shortest string leading to a pair satisfying the goal, or None if there is none
+    """
+    start = (a.start, b.start)
+    # The pair each pair was first reached from, and the symbol that led to it
+    reached = {start: None}
+    todo = deque([start])
+
+    while todo:
+        pair = todo.popleft()
+        if goal(*pair):
+            word = []
+            while reached[pair] is not None:
+                pair, symbol = reached[pair]
+                word.append(symbol)
+            return "".join(reversed(word))
+
+        p, q = pair
+        for symbol in alphabet:
+            nextpair = (a.next_state(p, symbol), b.next_state(q, symbol))
+            if nextpair not in reached:
+                reached[nextpair] = (pair, symbol)
+                todo.append(nextpair)
+
+    return None
+
+
+def deterministic_automaton(labels, positions, edges, start, acceptors):
+    """
+    Build an automaton from numbered states. States without a label are named q0, q1, ... skipping used names
+
+    :param labels: the label of every state, or None to generate one
+    :param positions: the position of every state
+    :param edges: for every state, a dict from each symbol to the number of the state it leads to
+    :param start: the number of the starting state, or None
+    :param acceptors: the numbers of the accepting states
+    :return: the automaton
+    """
+    used = {label for label in labels if label is not None}
+    names = []
+    i = 0
+    for label in labels:
+        if label is None:
+            while (label := f"q{i}") in used:
+                i += 1
+            used.add(label)
+        names.append(label)
+
+    automaton = Automaton()
+    for label, pos in zip(names, positions):
+        automaton.add_state(label, pos)
+
+    for s, row in enumerate(edges):
+        # Combine all symbols leading to the same state into a single transition
+        grouped = {}
+        for symbol, e in row.items():
+            grouped.setdefault(e, []).append(symbol)
+        for e, symbols in grouped.items():
+            # Bend transitions that have one going back, so the two do not overlap
+            if s == e:
+                vector = (60, 0.5 * math.pi)
+            elif s in edges[e].values():
+                vector = (30, 0.5)
+            else:
+                vector = (0, 0)
+            automaton.add_transition(names[s], names[e], ",".join(symbols), force_vector=vector)
 
-        if self.current in self.acceptors:
-            return steps, (self.current, "Accepted")
-        else:
-            return steps, (self.current, "Declined")
+    for a in acceptors:
+        automaton.add_acceptor(names[a])
+    if start is not None:
+        automaton.set_start(names[start])
+    return automaton
 
 
 def bezier(points, segments):
@@ -141,20 +1520,13 @@ def circle_from_3_points(a, b, c):
     return (round(center_x), round(center_y)), round(radius)
 
 
-def arc_to_polygon(center, r, width, start, stop, clockwise=True):
+def arc_to_polygon(center, r, width, start, stop, clockwise=True, segments=None):
     x, y = center
     outer = []
     inner = []
-    segments = r//2  # 200
-    sign = 1 if clockwise else -1
-
-    if stop < start:
-        stop += math.tau
-
-    if not clockwise:
-        start += math.tau
-
-    angle_segment = abs(start - stop) / segments
+    if segments is None:
+        segments = r//2  # 200
+    start, angle_segment, sign = arc_steps(start, stop, clockwise, segments)
 
     for n in range(segments + 1):
         arc_x = x + r * math.cos(start + (n * angle_segment * sign))
@@ -168,27 +1540,72 @@ def arc_to_polygon(center, r, width, start, stop, clockwise=True):
     return outer + list(reversed(inner))
 
 
-def draw_arc(surface, start, mid, end, color, return_path=False):
-    center, radius = circle_from_3_points(start, mid, end)
+def arc_polygons(centers, radii, width, starts, stops, clockwise, segments):
+    """
+    Work out the polygons of many arcs at once, with their points where arc_to_polygon would place them
+
+    :param centers: the centers of the arcs, shaped (arcs, 2)
+    :param radii: the radius of every arc
+    :param width: the width of the arcs
+    :param starts: the angle every arc starts at
+    :param stops: the angle every arc stops at
+    :param clockwise: for every arc whether it goes clockwise
+    :param segments: the number of segments of every arc
+    :return: an array of the points of all polygons, one polygon after the other, and where every polygon starts.
+             The points of a polygon go along the outer edge and back along the inner edge
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    radii = np.asarray(radii, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    stops = np.asarray(stops, dtype=float)
+    clockwise = np.asarray(clockwise, dtype=bool)
+    segments = np.asarray(segments, dtype=np.intp)
+
+    # The same steps as arc_steps, for all arcs
+    stops = np.where(stops < starts, stops + math.tau, stops)
+    starts = np.where(clockwise, starts, starts + math.tau)
+    steps = np.abs(starts - stops) / segments
+    signs = np.where(clockwise, 1, -1)
+
+    # The arc and the number along it of every point of all polygons, laid out one polygon after the other
+    counts = 2 * (segments + 1)
+    offsets = np.cumsum(counts) - counts
+    arc = np.repeat(np.arange(len(counts)), counts)
+    n = np.arange(counts.sum()) - offsets[arc]
+    inner = n > segments[arc]
+    n = np.where(inner, 2 * segments[arc] + 1 - n, n)
+
+    angles = starts[arc] + (n * steps[arc] * signs[arc])
+    r = radii[arc] - np.where(inner, width / 2, 0)
+    points = np.stack([centers[arc, 0] + r * np.cos(angles), centers[arc, 1] + r * np.sin(angles)], axis=-1)
+    return points, offsets
+
+
+# Get the angle of the first point of an arc, the angle between its points and the direction it goes in
+def arc_steps(start, stop, clockwise, segments):
+    if stop < start:
+        stop += math.tau
+
+    if not clockwise:
+        start += math.tau
+
+    return start, abs(start - stop) / segments, 1 if clockwise else -1
 
-    if center is not None:
-        start_angle, end_angle, is_reversed = adjusted_angles(start, mid, end)
 
-        path = arc_to_polygon(center, radius, 3, start_angle, end_angle, not is_reversed)
-        pygame.gfxdraw.aapolygon(surface, path, color)
-        pygame.gfxdraw.filled_polygon(surface, path, color)
+# Get the box around an arc of a circle, from the angle 'start' turning by 'sweep'
+def arc_box(center, r, start, sweep):
+    first, last = (start, start + sweep) if sweep >= 0 else (start + sweep, start)
+    xs = [math.cos(first), math.cos(last)]
+    ys = [math.sin(first), math.sin(last)]
 
-        if return_path:
-            return path
-    else:
-        x1, y1 = start
-        x2, y2 = end
+    # The points furthest left, right, up or down, where the arc passes them
+    quarter = math.ceil(first / (math.pi / 2))
+    while quarter * math.pi / 2 <= last:
+        xs.append((1, 0, -1, 0)[quarter % 4])
+        ys.append((0, 1, 0, -1)[quarter % 4])
+        quarter += 1
 
-        # Calculate the angle between them and move the starting and ending points to the edge of the states
-        angle = get_angle(start, end)
-        adjusted_start = (x1 - (math.cos(angle) * 30), y1 - (math.sin(angle) * 30))
-        adjusted_end = (x2 + (math.cos(angle) * 30), y2 + (math.sin(angle) * 30))
-        pygame.draw.line(surface, color, adjusted_start, adjusted_end, 3)
+    return center[0] + r * min(xs), center[1] + r * min(ys), center[0] + r * max(xs), center[1] + r * max(ys)
 
 
 # Get the angle from a to b, in radians
@@ -254,50 +1671,287 @@ def adjusted_angles(start, mid, end):
     return start_angle, end_angle, is_reversed
 
 
-# DISTANCE POINT TO LINE SEGMENT
-def point_to_segment(pnt, start, end):
-    def dot(v, w):
-        x, y = v
-        X, Y = w
-        return x*X + y*Y
-
-    def length(v):
-        x, y = v
-        return math.sqrt(x*x + y*y)
-
-    def vector(b, e):
-        x, y = b
-        X, Y = e
-        return X - x, Y - y
+class TransitionGeometry:
+    """
+    Everything needed to draw a transition arrow and to tell whether it was clicked,
+    worked out once from the positions of its states and its force vector.
+    The outline of a curved arrow is only worked out when it is asked for, at the level of detail asked for
+    """
+    # The width of a curved arrow
+    width = 3
+    # Arcs are split into at most this many segments, which is still smooth for the widest arcs
+    most_segments = 128
 
-    def unit(v):
-        x, y = v
-        mag = length(v)
-        return x / mag, y / mag
-
-    def distance(p0, p1):
-        return length(vector(p0, p1))
+    def __init__(self, start, end, vector):
+        self.start = start
+        self.end = end
+        self.mid = from_vector(start, end, vector)
+        self.center, self.radius = circle_from_3_points(start, self.mid, end)
+        self.curved = self.center is not None
+        # Outlines of a curved arrow by their number of segments
+        self.outlines = {}
+
+        if self.curved:
+            start_angle, end_angle, is_reversed = adjusted_angles(start, self.mid, end)
+            self.angles = (start_angle, end_angle, not is_reversed)
+            self.segments = min(self.radius // 2, self.most_segments)
+            self.line = None
+
+            # The points of the full outline around the middle and the quarters of the arc, without the rest of it
+            length = 2 * (self.segments + 1)
+            pathmid = length // 2
+            angle = get_angle(self.point(pathmid - 2), self.point(pathmid - 1))
+            head = between(self.point(pathmid), self.point(pathmid - 1), 0.5)
+            self.label = between(self.point(length // 4), self.point(3 * length // 4), 0.5)
+
+            first, step, sign = arc_steps(*self.angles, self.segments)
+            left, top, right, bottom = arc_box(self.center, self.radius, first, self.segments * step * sign)
+            self.box = (left - 7, top - 7, right + 7, bottom + 7)
+        else:
+            # Move the starting and ending points of the line to the edge of the states
+            angle = get_angle(start, end)
+            self.line = ((start[0] - math.cos(angle) * 30, start[1] - math.sin(angle) * 30),
+                         (end[0] + math.cos(angle) * 30, end[1] + math.sin(angle) * 30))
+
+            head = self.line[1]
+            self.label = between(start, end, 0.5)
+            self.box = (min(start[0], end[0]) - 7, min(start[1], end[1]) - 7,
+                        max(start[0], end[0]) + 7, max(start[1], end[1]) + 7)
+
+        self.head = [head,
+                     (head[0] + math.cos(angle - 0.5) * 10, head[1] + math.sin(angle - 0.5) * 10),
+                     (head[0] + math.cos(angle + 0.5) * 10, head[1] + math.sin(angle + 0.5) * 10)]
+
+    def point(self, i):
+        """
+        Get a point of the full outline of a curved arrow, as arc_to_polygon would place it
+
+        :param i: the number of the point, going along the outer edge and back along the inner edge
+        :return: the point
+        """
+        first, step, sign = arc_steps(*self.angles, self.segments)
+        r = self.radius
+        if i > self.segments:
+            i = 2 * self.segments + 1 - i
+            r -= self.width / 2
+        return (self.center[0] + r * math.cos(first + (i * step * sign)),
+                self.center[1] + r * math.sin(first + (i * step * sign)))
+
+    def outline(self, segments=None):
+        """
+        Get the outline of a curved arrow
+
+        :param segments: the number of segments of each edge, by default as many as for a full size arrow
+        :return: the points of the outline, or None if the arrow is straight
+        """
+        if not self.curved:
+            return None
+        segments = self.detail(segments)
+        if segments not in self.outlines:
+            self.outlines[segments] = arc_to_polygon(self.center, self.radius, self.width, *self.angles,
+                                                     segments=segments)
+        return self.outlines[segments]
+
+    def detail(self, segments):
+        """
+        :param segments: a number of segments, or None for as many as for a full size arrow
+        :return: the number of segments the outline will have, which is never more than at full size
+        """
+        if segments is None or segments > self.segments:
+            return self.segments
+        return segments
+
+    def hit(self, pos, tolerance=1):
+        """
+        Check whether a position is on the arrow
+
+        :param pos: the position
+        :param tolerance: how many times further away than usual the position may be
+        :return: True if the position is on the arrow
+        """
+        if self.curved:
+            # The outline of a wide arc has few points for its length, so measure to its edges instead of its points
+            outline = np.array(self.outline(), dtype=float)
+            return bool((segment_distances(pos, outline[:-1], outline[1:]) < 5 * tolerance).any())
+        return point_to_segment(pos, self.start, self.end) < 7 * tolerance
+
+
+def batch_outlines(geometries, segments):
+    """
+    Get the outlines of many curved arrows, working out the ones that aren't known yet all at once
+
+    :param geometries: the TransitionGeometry of every curved arrow
+    :param segments: for every arrow the number of segments, or None for as many as for a full size arrow
+    :return: the outline of every arrow
+    """
+    counts = [g.detail(n) for g, n in zip(geometries, segments)]
+    missing = [(g, n) for g, n in zip(geometries, counts) if n not in g.outlines]
+    if missing:
+        points, offsets = arc_polygons([g.center for g, _ in missing], [g.radius for g, _ in missing],
+                                       TransitionGeometry.width, *zip(*(g.angles for g, _ in missing)),
+                                       [n for _, n in missing])
+        points = list(zip(points[:, 0].tolist(), points[:, 1].tolist()))
+        for (g, n), first in zip(missing, offsets.tolist()):
+            g.outlines[n] = points[first:first + 2 * (n + 1)]
+    return [g.outlines[n] for g, n in zip(geometries, counts)]
+
+
+class Grid:
+    """
+    A uniform grid of square cells holding items by their bounding boxes,
+    so the items that may contain a point are found without looking at all of them
+    """
+    # Items spanning more cells than this are kept aside and returned by every query
+    most_cells = 64
+
+    def __init__(self, cell=100):
+        self.cell = cell
+        self.cells = {}
+        self.large = []
+        self.count = 0
+
+    def insert(self, item, box):
+        """
+        :param item: the item
+        :param box: the (left, top, right, bottom) bounding box of the item
+        """
+        left, top, right, bottom = (math.floor(c / self.cell) for c in box)
+        entry = (self.count, item)
+        self.count += 1
+
+        if (right - left + 1) * (bottom - top + 1) > self.most_cells:
+            self.large.append(entry)
+            return
+        for i in range(left, right + 1):
+            for j in range(top, bottom + 1):
+                self.cells.setdefault((i, j), []).append(entry)
+
+    def query(self, pos):
+        """
+        :param pos: the point
+        :return: the items whose bounding boxes may contain the point, in the order they were inserted
+        """
+        entries = self.cells.get((math.floor(pos[0] / self.cell), math.floor(pos[1] / self.cell)), [])
+        if self.large:
+            entries = sorted(entries + self.large)
+        return [item for _, item in entries]
+
+    def query_box(self, box):
+        """
+        :param box: the (left, top, right, bottom) box
+        :return: the items whose bounding boxes may overlap the box, in the order they were inserted
+        """
+        left, top, right, bottom = (math.floor(c / self.cell) for c in box)
+
+        entries = set(self.large)
+        # Look through the cells in the box, or through all cells holding anything if there are fewer of those
+        if (right - left + 1) * (bottom - top + 1) > len(self.cells):
+            for (i, j), cell in self.cells.items():
+                if left <= i <= right and top <= j <= bottom:
+                    entries.update(cell)
+        else:
+            for i in range(left, right + 1):
+                for j in range(top, bottom + 1):
+                    entries.update(self.cells.get((i, j), ()))
+        return [item for _, item in sorted(entries)]
+
+    def query_segment(self, start, end):
+        """
+        :param start: the starting point of the line segment
+        :param end: the ending point of the line segment
+        :return: the items whose bounding boxes the line segment may pass through, in the order of the cells
+                 the segment passes through from its start, so an item spanning several cells can come up more than once
+        """
+        i, j = math.floor(start[0] / self.cell), math.floor(start[1] / self.cell)
+        last_i, last_j = math.floor(end[0] / self.cell), math.floor(end[1] / self.cell)
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        step_i, step_j = (1 if dx > 0 else -1), (1 if dy > 0 else -1)
+        # How far along the segment the next vertical and horizontal cell borders are, and the distance between them
+        next_x = ((i + (dx > 0)) * self.cell - start[0]) / dx if dx else math.inf
+        next_y = ((j + (dy > 0)) * self.cell - start[1]) / dy if dy else math.inf
+        across_x = self.cell / abs(dx) if dx else math.inf
+        across_y = self.cell / abs(dy) if dy else math.inf
+
+        # Go through the cells the segment passes through, one border at a time
+        for _, item in self.large:
+            yield item
+        for _, item in self.cells.get((i, j), ()):
+            yield item
+        for _ in range(abs(last_i - i) + abs(last_j - j)):
+            if j == last_j or (i != last_i and next_x < next_y):
+                i += step_i
+                next_x += across_x
+            else:
+                j += step_j
+                next_y += across_y
+            for _, item in self.cells.get((i, j), ()):
+                yield item
+
+
+class CoordinateIndex:
+    """
+    The x and the y coordinates of a collection of points, each kept sorted,
+    so the coordinate nearest to a value is found by bisection
+    """
+    def __init__(self, points=()):
+        points = list(points)
+        self.xs = sorted(x for x, _ in points)
+        self.ys = sorted(y for _, y in points)
+
+    @staticmethod
+    def nearest(values, value, tolerance):
+        """
+        :param values: sorted coordinates
+        :param value: the coordinate to look near
+        :param tolerance: how far away the nearest coordinate may be
+        :return: the coordinate nearest to the value, or None if there is none within the tolerance
+        """
+        i = bisect_left(values, value)
+        # Only the coordinates on either side of where the value would go can be the nearest
+        best = min(values[max(i - 1, 0):i + 1], key=lambda c: abs(c - value), default=None)
+        return best if best is not None and abs(best - value) <= tolerance else None
+
+    def nearest_x(self, value, tolerance):
+        return self.nearest(self.xs, value, tolerance)
+
+    def nearest_y(self, value, tolerance):
+        return self.nearest(self.ys, value, tolerance)
 
-    def scale(v, sc):
-        x, y = v
-        return x * sc, y * sc
 
+# DISTANCE POINT TO LINE SEGMENT
+def point_to_segment(pnt, start, end):
     if start == end:
         return math.dist(pnt, start)
-    else:
-        line_vec = vector(start, end)
-        pnt_vec = vector(start, pnt)
-        line_len = length(line_vec)
-        line_unitvec = unit(line_vec)
-        pnt_vec_scaled = scale(pnt_vec, 1.0 / line_len)
-        t = dot(line_unitvec, pnt_vec_scaled)
-        if t < 0.0:
-            t = 0.0
-        elif t > 1.0:
-            t = 1.0
-        nearest = scale(line_vec, t)
-        dist = distance(nearest, pnt_vec)
-        return dist
+
+    line_x, line_y = end[0] - start[0], end[1] - start[1]
+    pnt_x, pnt_y = pnt[0] - start[0], pnt[1] - start[1]
+    line_len = math.hypot(line_x, line_y)
+    # How far along the line the nearest point is, between 0 at the start and 1 at the end
+    t = min(max((line_x * pnt_x + line_y * pnt_y) / line_len / line_len, 0.0), 1.0)
+    return math.hypot(pnt_x - line_x * t, pnt_y - line_y * t)
+
+
+def segment_distances(points, starts, ends):
+    """
+    Work out the distances from many points to many line segments at once, like point_to_segment does
+
+    :param points: an array of points, shaped (..., 2)
+    :param starts: an array of the starting points of the segments, shaped (..., 2)
+    :param ends: an array of the ending points of the segments, shaped (..., 2)
+    :return: an array of the distances, in the shape the points and segments broadcast to
+    """
+    points = np.asarray(points, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+
+    line = ends - starts
+    pnt = points - starts
+    squared = (line * line).sum(axis=-1)
+    # How far along the line the nearest point is, which is the start for segments without length
+    along = np.divide((line * pnt).sum(axis=-1), squared, out=np.zeros(np.broadcast(pnt[..., 0], squared).shape),
+                      where=squared > 0)
+    nearest = pnt - line * np.clip(along, 0.0, 1.0)[..., None]
+    return np.hypot(nearest[..., 0], nearest[..., 1])
 
 
 # test = Automaton()
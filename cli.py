@@ -0,0 +1,256 @@
+import argparse
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from algorithm import Automaton, StartError, open_binary
+from fsaformat import BinaryFormatError, FSAParseError
+from layout import force_layout
+
+# Headless command line interface, which works without pygame
+#
+# usage: python cli.py run 010 0100 0110
+#        python cli.py run 010 -f words.txt -j 8
+#        python cli.py equiv 010 011
+#        python cli.py subset 010 011
+#        python cli.py combine intersection 010 011 both
+#        python cli.py complement 010 not010
+#        python cli.py pack 010
+#        python cli.py layout 010 010_laid_out
+
+
+# The compiled automaton of a worker process, handed over once by the pool initializer
+worker_automaton = None
+
+
+def find_file(name):
+    """
+    Find an automaton file, given either as a path or as the name of a file in 'saves'.
+    A name without an extension means the .fsa file, unless there is a .fsab file packed from it that is at least
+    as new, as the editor only ever writes .fsa files and a packed copy goes stale once the .fsa file is edited
+
+    :param name: the path or name of the file
+    :return: the path of the file
+    """
+    if os.path.isfile(name):
+        return name
+    if name.endswith((".fsa", ".fsab")):
+        return os.path.join("saves", name)
+
+    text, binary = os.path.join("saves", name + ".fsa"), os.path.join("saves", name + ".fsab")
+    if os.path.isfile(binary) and (not os.path.isfile(text) or os.path.getmtime(binary) >= os.path.getmtime(text)):
+        return binary
+    return text
+
+
+def open_automaton(name):
+    """
+    Load an automaton from a .fsa or binary .fsab file, given either as a path or as the name of a file in 'saves'
+
+    :param name: the path or name of the file
+    :return: the loaded automaton
+    """
+    path = find_file(name)
+    automaton = Automaton()
+
+    if path.endswith(".fsab"):
+        automaton.load_binary(path)
+    else:
+        automaton.load(path)
+    return automaton
+
+
+def save_automaton(automaton, name):
+    """
+    Save an automaton to a .fsa file, given either as a path or as the name of a file in 'saves'
+
+    :param automaton: the automaton to save
+    :param name: the path or name of the file
+    """
+    path = name if os.path.dirname(name) else os.path.join("saves", name if name.endswith(".fsa") else f"{name}.fsa")
+    automaton.save(path)
+
+
+def read_words(args):
+    """
+    Yield the words given on the command line, or read from a file with one word per line
+
+    :param args: the parsed command line arguments
+    """
+    if args.file is None:
+        yield from args.words
+        return
+
+    f = sys.stdin if args.file == "-" else open(args.file)
+    try:
+        for line in f:
+            yield line.rstrip("\r\n")
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def init_worker(source):
+    global worker_automaton
+    # Binary files are mapped by every worker, so they all share the operating system's cached copy of the table
+    if isinstance(source, str):
+        worker_automaton = open_binary(source)
+    else:
+        worker_automaton = source.compile()
+
+
+def run_shard(words):
+    accepted, _ = worker_automaton.run_batch(words)
+    return accepted.tolist()
+
+
+def run_parallel(automaton, words, jobs, shard_size):
+    """
+    Run words through an automaton on a pool of worker processes, yielding the results in input order.
+    Only a limited number of shards is in flight at once, so arbitrarily long word lists are streamed
+
+    :param automaton: the automaton to run the words through, or the path of a binary automaton file
+    :param words: an iterable of words
+    :param jobs: the number of worker processes
+    :param shard_size: the number of words handed to a worker at once
+    """
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(automaton,)) as pool:
+        pending = deque()
+        words = iter(words)
+
+        while True:
+            while len(pending) < 2 * jobs and (shard := list(islice(words, shard_size))):
+                pending.append((shard, pool.submit(run_shard, shard)))
+            if not pending:
+                break
+
+            shard, future = pending.popleft()
+            yield from zip(shard, future.result())
+
+
+def command_run(args):
+    path = find_file(args.automaton)
+    if path.endswith(".fsab"):
+        source = path
+        compiled = open_binary(path)
+    else:
+        source = Automaton()
+        source.load(path)
+        compiled = source.compile()
+    if compiled.start is None:
+        raise StartError
+
+    out = sys.stdout
+    for word, accepted in run_parallel(source, read_words(args), args.jobs, args.shard_size):
+        out.write(f"{'Accepted' if accepted else 'Declined'} {word}\n")
+
+
+def command_equiv(args):
+    equivalent, word = open_automaton(args.first).equivalent(open_automaton(args.second))
+    if equivalent:
+        print("Equivalent")
+    else:
+        print(f"Not equivalent, distinguished by \"{word}\"")
+        sys.exit(1)
+
+
+def command_subset(args):
+    included, word = open_automaton(args.first).subset_of(open_automaton(args.second))
+    if included:
+        print("Included")
+    else:
+        print(f"Not included, \"{word}\" is only accepted by the first")
+        sys.exit(1)
+
+
+def command_pack(args):
+    automaton = open_automaton(args.automaton)
+    output = args.output if args.output is not None else os.path.splitext(find_file(args.automaton))[0]
+    if not output.endswith(".fsab"):
+        output += ".fsab"
+    automaton.save_binary(output)
+
+
+def command_layout(args):
+    automaton = open_automaton(args.automaton)
+    force_layout(automaton)
+    save_automaton(automaton, args.output if args.output is not None
+                   else os.path.splitext(find_file(args.automaton))[0] + ".fsa")
+
+
+def command_combine(args):
+    first, second = open_automaton(args.first), open_automaton(args.second)
+    save_automaton(getattr(first, args.operation)(second), args.output)
+
+
+def command_complement(args):
+    automaton = open_automaton(args.automaton)
+    save_automaton(automaton.complement(args.alphabet), args.output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Finite State Automata Simulator (headless)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run words through an automaton")
+    run.add_argument("automaton", help="a .fsa or .fsab file, or the name of a file in 'saves'")
+    run.add_argument("words", nargs="*", help="the words to run")
+    run.add_argument("-f", "--file", help="read one word per line from this file ('-' for stdin)")
+    run.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    run.add_argument("--shard-size", type=int, default=10000, help="number of words per worker task")
+    run.set_defaults(func=command_run)
+
+    equiv = commands.add_parser("equiv", help="check whether two automata accept the same strings")
+    equiv.add_argument("first", help="a .fsa file, or the name of a file in 'saves'")
+    equiv.add_argument("second", help="a .fsa file, or the name of a file in 'saves'")
+    equiv.set_defaults(func=command_equiv)
+
+    subset = commands.add_parser("subset", help="check whether every string the first accepts, the second accepts")
+    subset.add_argument("first", help="a .fsa file, or the name of a file in 'saves'")
+    subset.add_argument("second", help="a .fsa file, or the name of a file in 'saves'")
+    subset.set_defaults(func=command_subset)
+
+    combine = commands.add_parser("combine", help="save the product of two automata")
+    combine.add_argument("operation", choices=["intersection", "union", "difference"])
+    combine.add_argument("first", help="a .fsa file, or the name of a file in 'saves'")
+    combine.add_argument("second", help="a .fsa file, or the name of a file in 'saves'")
+    combine.add_argument("output", help="the .fsa file to write, or the name of a file in 'saves'")
+    combine.set_defaults(func=command_combine)
+
+    complement = commands.add_parser("complement", help="save an automaton accepting the strings another rejects")
+    complement.add_argument("automaton", help="a .fsa file, or the name of a file in 'saves'")
+    complement.add_argument("output", help="the .fsa file to write, or the name of a file in 'saves'")
+    complement.add_argument("-a", "--alphabet", help="the symbols strings consist of (default: those used)")
+    complement.set_defaults(func=command_complement)
+
+    pack = commands.add_parser("pack", help="save an automaton in the binary format, for fast loading")
+    pack.add_argument("automaton", help="a .fsa file, or the name of a file in 'saves'")
+    pack.add_argument("output", nargs="?", help="the .fsab file to write (default: next to the .fsa file)")
+    pack.set_defaults(func=command_pack)
+
+    layout = commands.add_parser("layout", help="place the states of an automaton with a force-directed layout")
+    layout.add_argument("automaton", help="a .fsa or .fsab file, or the name of a file in 'saves'")
+    layout.add_argument("output", nargs="?", help="the .fsa file to write (default: the .fsa file itself)")
+    layout.set_defaults(func=command_layout)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args, _ = parser.parse_known_args(argv)
+    # Parse the arguments of the command again on their own, so words may come after the options as well as before
+    # them, which parse_intermixed_args can't do for a parser with sub-commands
+    args = commands.choices[args.command].parse_intermixed_args(argv[1:])
+    try:
+        args.func(args)
+    except StartError:
+        sys.exit("The automaton has no starting state")
+    except FileNotFoundError as e:
+        sys.exit(f"No such file: {e.filename}")
+    except FSAParseError as e:
+        sys.exit(f"Invalid .fsa file, {e}")
+    except BinaryFormatError as e:
+        sys.exit(f"Invalid .fsab file, {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,523 @@
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from contextlib import contextmanager
+
+# This module reads and writes the .fsa text format. A file has four lines:
+#
+#   q0,(363, 313);q1,(516, 313)          - states with their positions, separated by ';'
+#   q0_0,1_q1_(0, 0);q1_1_q1_(60, 1.57)  - transitions as start_via_end_(force vector), separated by ';'
+#   q1                                   - accepting states, separated by ','
+#   q0                                   - the starting state, if there is one
+#
+# Characters of labels that would be read as separators are escaped with a backslash.
+# Files are read and written in chunks, so no line is ever held in memory as a whole.
+
+
+class FSAParseError(Exception):
+    def __init__(self, message, line, column):
+        super().__init__(f"line {line}, column {column}: {message}")
+        self.line = line
+        self.column = column
+
+
+class BinaryFormatError(Exception):
+    def __init__(self, message, offset):
+        super().__init__(f"byte {offset}: {message}")
+        self.offset = offset
+
+
+LABEL = r"((?:[^\\_;,\r\n]|\\.)*)"
+VIA = r"((?:[^\\_;\r\n]|\\.)*)"
+NUMBER = r"\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?inf|nan)\s*"
+PAIR = rf"\({NUMBER},{NUMBER}\)"
+
+STATE = re.compile(rf"{LABEL},{PAIR}")
+TRANSITION = re.compile(rf"{LABEL}_{VIA}_{LABEL}_{PAIR}")
+ACCEPTOR = re.compile(LABEL)
+UNESCAPE = re.compile(r"\\(.)")
+
+# The number of characters read at once
+read_size = 1 << 16
+# The number of records joined before they are written
+write_size = 1024
+
+
+def escape(label, keep=""):
+    """
+    Escape the characters of a label that would be read as separators
+
+    :param label: the label
+    :param keep: separators that may appear unescaped, like the ',' between the values of a transition
+    :return: the escaped label
+    """
+    for c in "\\_;,":
+        if c not in keep and c in label:
+            label = label.replace(c, "\\" + c)
+    return label
+
+
+def unescape(label):
+    return UNESCAPE.sub(r"\1", label) if "\\" in label else label
+
+
+def line_break(text, start=0):
+    """
+    :return: the position of the first line break in the text after the start, or None if there is none
+    """
+    end = text.find("\n", start)
+    if end == -1:
+        end = len(text)
+    if (carriage_return := text.find("\r", start, end)) != -1:
+        return carriage_return
+    return end if end < len(text) else None
+
+
+def number(token):
+    return int(token) if token.lstrip("+-").isdigit() else float(token)
+
+
+class Reader:
+    """
+    Reads a text file chunk by chunk, keeping only the part of the current line that has not been parsed yet
+    """
+    def __init__(self, f, progress=None):
+        self.f = f
+        self.progress = progress
+        self.read = 0
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.line = 1
+        # The column of the start of the buffer
+        self.offset = 1
+        # The position of the line break ending the current line, once it is in the buffer
+        self.end = None
+
+    def fill(self):
+        """
+        Drop the parsed part of the buffer and read the next chunk
+
+        :return: whether anything was read
+        """
+        if self.eof:
+            return False
+
+        chunk = self.f.read(read_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.read += len(chunk)
+        if self.progress is not None:
+            self.progress(self.read)
+
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.end = line_break(self.buffer)
+        return True
+
+    def column(self):
+        return self.offset + self.pos
+
+    def line_end(self):
+        """
+        Read until the end of the current line is in the buffer
+
+        :return: the position of the end of the current line
+        """
+        while self.end is None and self.fill():
+            pass
+        return len(self.buffer) if self.end is None else self.end
+
+    def at_end(self):
+        if self.pos == len(self.buffer) and not self.fill():
+            return True
+        return self.pos == self.end
+
+    def match(self, pattern):
+        """
+        Match a pattern at the current position, reading more of the line when the buffer may have cut it short
+
+        :param pattern: the compiled pattern
+        :return: the match, or None if the line does not match
+        """
+        while True:
+            if self.end is not None:
+                return pattern.match(self.buffer, self.pos, self.end)
+            # Without the end of the line, a match is only known to be complete when the pattern could see past it,
+            # which takes two characters for an escaped character
+            match = pattern.match(self.buffer, self.pos)
+            if match is not None and match.end() + 1 < len(self.buffer):
+                return match
+            if not self.fill():
+                return pattern.match(self.buffer, self.pos)
+
+    def rest(self):
+        """
+        :return: the unparsed part of the current line
+        """
+        end = self.line_end()
+        rest = self.buffer[self.pos:end]
+        self.pos = end
+        return rest
+
+    def next_line(self):
+        """
+        Move past the line break ending the current line
+
+        :return: whether there is another line
+        """
+        end = self.line_end()
+        if end == len(self.buffer):
+            return False
+
+        carriage_return = self.buffer[end] == "\r"
+        self.pos = end + 1
+        if carriage_return and self.pos == len(self.buffer):
+            self.fill()
+        if carriage_return and self.buffer.startswith("\n", self.pos):
+            self.pos += 1
+
+        self.line += 1
+        self.offset = 1 - self.pos
+        self.end = line_break(self.buffer, self.pos)
+        return self.pos < len(self.buffer) or self.fill()
+
+
+def records(reader, pattern, separator, what):
+    """
+    Match the current line record by record, checking that records are separated by exactly one separator
+
+    :param reader: the reader, at the start of the line
+    :param pattern: the compiled pattern of a single record
+    :param separator: the character between records
+    :param what: the name of a record, for error messages
+    """
+    if reader.at_end():
+        return
+
+    while True:
+        match = reader.match(pattern)
+        if match is None:
+            raise FSAParseError(f"expected a {what}", reader.line, reader.column())
+        yield match
+
+        reader.pos = match.end()
+        if reader.at_end():
+            return
+        if reader.buffer[reader.pos] != separator:
+            raise FSAParseError(f"expected '{separator}' after {what}", reader.line, reader.column())
+        reader.pos += 1
+
+
+def parse(f, progress=None):
+    """
+    Parse a .fsa file
+
+    :param f: the file, opened for reading text
+    :param progress: an optional function called with the number of characters read after every chunk
+    :return: the states, transitions, acceptors and starting state, in the form used by Automaton
+    """
+    reader = Reader(f, progress)
+
+    def next_line():
+        line = reader.line + 1
+        if not reader.next_line():
+            raise FSAParseError("expected four lines", line, 1)
+
+    if not reader.fill():
+        raise FSAParseError("expected four lines", 1, 1)
+
+    states = {}
+    for match in records(reader, STATE, ";", "state"):
+        label, x, y = match.groups()
+        states[unescape(label)] = (number(x), number(y))
+    next_line()
+
+    def known(label):
+        if label not in states:
+            raise FSAParseError(f"unknown state '{label}'", reader.line, reader.column())
+        return label
+
+    transitions = {}
+    for match in records(reader, TRANSITION, ";", "transition"):
+        s, v, e, distance, angle = match.groups()
+        transitions[(known(unescape(s)), unescape(v), known(unescape(e)))] = (number(distance), number(angle))
+    next_line()
+
+    acceptors = [known(unescape(match.group(1))) for match in records(reader, ACCEPTOR, ",", "state")]
+    next_line()
+
+    start = unescape(reader.rest()) or None
+    if start is not None and start not in states:
+        raise FSAParseError(f"unknown state '{start}'", reader.line, 1)
+
+    # Nothing but empty lines may follow the starting state
+    while reader.next_line():
+        if reader.rest().strip():
+            raise FSAParseError("expected the end of the file", reader.line, 1)
+
+    return states, transitions, acceptors, start
+
+
+def write_records(f, records, separator, written=None):
+    """
+    Write records as one line, joining them in chunks
+
+    :param f: the file, opened for writing text
+    :param records: an iterable of formatted records
+    :param separator: the character between records
+    :param written: an optional function called with the number of records in every chunk written
+    """
+    chunk = []
+    first = True
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == write_size:
+            f.write(separator.join(chunk) if first else separator + separator.join(chunk))
+            first = False
+            chunk.clear()
+            if written is not None:
+                written(write_size)
+    if chunk and not first:
+        f.write(separator)
+    f.write(separator.join(chunk) + "\n")
+
+
+def write(automaton, f, progress=None):
+    """
+    Write an automaton in the .fsa format
+
+    :param automaton: the automaton
+    :param f: the file, opened for writing text
+    :param progress: an optional function called with the fraction of records written after every chunk
+    """
+    written = None
+    if progress is not None:
+        total = len(automaton.states) + len(automaton.transitions) + len(automaton.acceptors) or 1
+        count = 0
+
+        def written(records):
+            nonlocal count
+            count += records
+            progress(count / total)
+
+    write_records(f, (f"{escape(lbl)},({x}, {y})" for lbl, (x, y) in automaton.states.items()), ";", written)
+    write_records(f, (f"{escape(s)}_{escape(v, keep=',')}_{escape(e)}_({m[0]}, {m[1]})"
+                      for (s, v, e), m in automaton.transitions.items()), ";", written)
+    write_records(f, (escape(a) for a in automaton.acceptors), ",", written)
+    f.write((escape(automaton.start) if automaton.start is not None else "") + "\n")
+
+
+@contextmanager
+def replacing(path, mode="w", **kwargs):
+    """
+    Open a temporary file next to the given path, which replaces it once everything has been written.
+    If writing fails, the original file is left untouched
+
+    :param path: the path of the file to replace
+    :param mode: the mode to open the temporary file with
+    """
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary, mode, **kwargs) as f:
+            yield f
+            # Make sure the data is on disk before the rename is, or a crash could leave an empty or partial file
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+# The binary .fsab format holds the same automaton as a .fsa file, plus its complete deterministic transition table,
+# laid out so it can be memory-mapped and used without parsing. All numbers are in native byte order:
+#
+#   header            - see BINARY_HEADER
+#   string offsets    - uint32 per string, plus one for the end of the last
+#   string data       - UTF-8 labels of the states, transitions, symbols and deterministic states, in that order
+#   positions         - float64 x, y per state
+#   force vectors     - float64 distance, angle per transition
+#   transition states - uint32 start, end per transition, as state numbers
+#   acceptors         - uint32 per accepting state
+#   accepting         - uint8 per deterministic state
+#   table             - int32 per deterministic state per symbol, plus the column for unknown characters
+#   member offsets    - uint32 per deterministic state, plus one for the end of the last
+#   members           - uint32 state numbers making up every deterministic state
+#
+# Every section starts at a multiple of 8 bytes.
+
+BINARY_MAGIC = b"FSAB"
+BINARY_VERSION = 1
+BYTE_ORDER_MARK = 0xFEFF
+# magic, version, byte order mark, states, transitions, acceptors, start, strings, string bytes,
+# symbols, deterministic states, deterministic start, members
+BINARY_HEADER = struct.Struct("=4sHH10i")
+# Marks a missing starting state in the binary header
+NO_START = -1
+
+
+def padding(size):
+    return -size % 8
+
+
+def write_binary(automaton, f):
+    """
+    Write an automaton and its complete deterministic transition table in the binary format
+
+    :param automaton: the automaton
+    :param f: a file opened for writing bytes
+    """
+    compiled = automaton.compile()
+    compiled.explore()
+
+    # Number every state, including states only mentioned by transitions
+    labels = list(automaton.states)
+    numbers = {label: i for i, label in enumerate(labels)}
+    for s, _, e in automaton.transitions:
+        for label in (s, e):
+            if label not in numbers:
+                numbers[label] = len(labels)
+                labels.append(label)
+    acceptors = [a for a in automaton.acceptors if a in numbers]
+    start = numbers.get(automaton.start, -1)
+
+    strings = [s.encode("utf-8") for s in labels]
+    strings += [v.encode("utf-8") for _, v, _ in automaton.transitions]
+    strings += [c.encode("utf-8") for c in compiled.alphabet]
+    strings += [label.encode("utf-8") for label in compiled.labels]
+    offsets = array("I", [0])
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+
+    members = [[numbers[label] for label in compiled.state_members(q)] for q in range(len(compiled.labels))]
+    member_offsets = array("I", [0])
+    for m in members:
+        member_offsets.append(member_offsets[-1] + len(m))
+
+    dfa_start = NO_START if compiled.start is None else compiled.start
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BYTE_ORDER_MARK, len(labels), len(automaton.transitions),
+                               len(acceptors), start, len(strings), offsets[-1], len(compiled.alphabet),
+                               len(compiled.labels), dfa_start, member_offsets[-1]))
+
+    def section(data, size):
+        f.write(data)
+        f.write(bytes(padding(size)))
+
+    section(offsets, offsets.itemsize * len(offsets))
+    for s in strings:
+        f.write(s)
+    f.write(bytes(padding(offsets[-1])))
+
+    positions = array("d")
+    for label in labels:
+        positions.extend(automaton.states.get(label, (0, 0)))
+    section(positions, positions.itemsize * len(positions))
+
+    vectors = array("d")
+    ends = array("I")
+    for (s, _, e), m in automaton.transitions.items():
+        vectors.extend(m)
+        ends.extend((numbers[s], numbers[e]))
+    section(vectors, vectors.itemsize * len(vectors))
+    section(ends, ends.itemsize * len(ends))
+
+    accepting = array("I", [numbers[a] for a in acceptors])
+    section(accepting, accepting.itemsize * len(accepting))
+    section(compiled.accepting, len(compiled.accepting))
+    section(compiled.table, compiled.table.itemsize * len(compiled.table))
+    section(member_offsets, member_offsets.itemsize * len(member_offsets))
+
+    data = array("I", [s for m in members for s in m])
+    section(data, data.itemsize * len(data))
+
+
+class BinaryFile:
+    """
+    A memory-mapped binary automaton file, whose sections are exposed as memoryviews without copying anything
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            # An empty file can't be mapped at all
+            if os.fstat(f.fileno()).st_size < BINARY_HEADER.size:
+                raise BinaryFormatError("file too short for a header", 0)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, mark, self.states, self.transitions, self.acceptors, self.start, self.strings,
+         string_bytes, self.symbols, self.rows, self.dfa_start, members) = BINARY_HEADER.unpack_from(self.map)
+        if magic != BINARY_MAGIC or mark != BYTE_ORDER_MARK:
+            raise BinaryFormatError("not a binary automaton file of this machine's byte order", 0)
+        if version != BINARY_VERSION:
+            raise BinaryFormatError(f"unsupported version {version}", 4)
+        if min(self.states, self.transitions, self.acceptors, self.strings, string_bytes, self.symbols, self.rows,
+               members) < 0:
+            raise BinaryFormatError("negative count in the header", 8)
+        if not NO_START <= self.start < self.states or not NO_START <= self.dfa_start < self.rows:
+            raise BinaryFormatError("starting state out of range in the header", 8)
+
+        self.view = memoryview(self.map)
+        self.pos = BINARY_HEADER.size
+
+        self.string_offsets = self.section(self.strings + 1, "I")
+        self.string_data = self.section(string_bytes, "B")
+        self.positions = self.section(self.states * 2, "d")
+        self.vectors = self.section(self.transitions * 2, "d")
+        self.ends = self.section(self.transitions * 2, "I")
+        self.acceptor_states = self.section(self.acceptors, "I")
+        self.accepting = self.section(self.rows, "B")
+        self.table = self.section(self.rows * (self.symbols + 1), "i")
+        self.member_offsets = self.section(self.rows + 1, "I")
+        self.members = self.section(members, "I")
+
+    def section(self, count, kind):
+        size = count * array(kind).itemsize
+        if self.pos + size > len(self.map):
+            raise BinaryFormatError("file ends in the middle of a section", self.pos)
+
+        data = self.view[self.pos:self.pos + size].cast(kind)
+        self.pos += size + padding(size)
+        return data
+
+    def string(self, i):
+        """
+        :param i: the number of the string
+        :return: the decoded string
+        """
+        return str(self.string_data[self.string_offsets[i]:self.string_offsets[i + 1]], "utf-8")
+
+    def state_labels(self):
+        return Strings(self, 0, self.states)
+
+    def transition_labels(self):
+        return Strings(self, self.states, self.transitions)
+
+    def symbol_labels(self):
+        return Strings(self, self.states + self.transitions, self.symbols)
+
+    def dfa_labels(self):
+        return Strings(self, self.states + self.transitions + self.symbols, self.rows)
+
+
+class Strings:
+    """
+    A run of strings of a binary automaton file, which are only decoded when they are asked for
+    """
+    def __init__(self, binary, first, count):
+        self.binary = binary
+        self.first = first
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.binary.string(self.first + i)
@@ -0,0 +1,208 @@
+import math
+
+import numpy as np
+
+from algorithm import bend_transitions
+
+# This module lays out the states of an automaton by simulating forces between them:
+# every two states push each other away, and every transition pulls its two states together.
+# Pushing is approximated with a Barnes-Hut quadtree, so a step takes O(n log n) time instead of O(n^2),
+# and the forces are worked out for all states at once with NumPy.
+
+
+def repulsion(points, strength, theta=1.0, near=0):
+    """
+    Work out how hard every point is pushed away by all other points, with a force of strength / distance.
+    Groups of points far away compared to their size push as one point at their center of mass
+
+    :param points: an array of points, shaped (n, 2)
+    :param strength: the strength of the force
+    :param theta: how small a group has to look from a point to be taken as one, smaller is more exact
+    :param near: points closer than this push each other away a lot harder, so they don't end up on top of each other
+    :return: an array of the forces on every point, shaped (n, 2)
+    """
+    n = len(points)
+    forces = np.zeros_like(points)
+    if n < 2:
+        return forces
+
+    # Every level of the quadtree splits the cells of the level above in four, until they hold a few points each
+    low = points.min(axis=0)
+    size = max(float((points.max(axis=0) - low).max()), 1.0) * (1 + 1e-9)
+    depth = min(16, max(1, math.ceil(math.log(n, 4))))
+    cells = np.minimum(((points - low) / size * (1 << depth)).astype(np.int64), (1 << depth) - 1)
+
+    # For every level the keys of the cells holding points, how many points they hold, their center of mass,
+    # and the cell every point is in
+    levels = []
+    for level in range(depth + 1):
+        x, y = cells[:, 0] >> (depth - level), cells[:, 1] >> (depth - level)
+        keys, inside = np.unique((x << level) | y, return_inverse=True)
+        mass = np.bincount(inside, minlength=len(keys))
+        sums = np.stack([np.bincount(inside, points[:, axis], len(keys)) for axis in range(2)], -1)
+        levels.append((keys, mass, sums, sums / mass[:, None], inside))
+
+    # For every cell the four cells inside it on the next level, or -1 for the ones that don't hold any points
+    children = []
+    for level in range(depth):
+        keys, following = levels[level][0], levels[level + 1][0]
+        x, y = keys >> level, keys & ((1 << level) - 1)
+        quarters = ((2 * x[:, None] + np.array([0, 0, 1, 1])) << (level + 1)) | (2 * y[:, None] + np.array([0, 1, 0, 1]))
+        found = np.minimum(np.searchsorted(following, quarters), len(following) - 1)
+        children.append(np.where(following[found] == quarters, found, -1))
+
+    # Pairs of a point and a cell still to look at, starting with every point and the root
+    who = np.arange(n)
+    node = np.zeros(n, dtype=np.intp)
+    for level, (keys, mass, sums, centers, inside) in enumerate(levels):
+        m = mass[node].astype(float)
+        center = centers[node]
+        # A point doesn't push itself, so it is taken out of the cell it is in
+        own = np.flatnonzero(inside[who] == node)
+        m[own] -= 1
+        center[own] = (sums[node[own]] - points[who[own]]) / np.maximum(m[own], 1)[:, None]
+
+        offset = points[who] - center
+        squared = np.maximum((offset * offset).sum(axis=1), 1.0)
+        # Take a cell as one when it looks small enough from the point
+        whole = (size / (1 << level)) ** 2 < theta * theta * squared
+        whole[own] = False
+
+        push = offset[whole] * (strength * m[whole] / squared[whole])[:, None]
+        forces[:, 0] += np.bincount(who[whole], push[:, 0], n)
+        forces[:, 1] += np.bincount(who[whole], push[:, 1], n)
+
+        if level == depth:
+            # The cells on the last level that are near push with every point in them, apart from the point itself
+            who, node = who[~whole], node[~whole]
+            # The points sorted by cell, so the points in a cell follow each other
+            order = np.argsort(inside, kind='stable')
+            counts = mass[node]
+            pairs = np.repeat(who, counts)
+            skip = np.repeat((np.cumsum(mass) - mass)[node] - (np.cumsum(counts) - counts), counts)
+            others = order[skip + np.arange(len(pairs))]
+            pairs, others = pairs[pairs != others], others[pairs != others]
+
+            offset = points[pairs] - points[others]
+            squared = np.maximum((offset * offset).sum(axis=1), 1.0)
+            push = offset * (strength / squared * np.maximum(1.0, near * near / squared))[:, None]
+            forces[:, 0] += np.bincount(pairs, push[:, 0], n)
+            forces[:, 1] += np.bincount(pairs, push[:, 1], n)
+            break
+
+        # Look at the cells inside the others on the next level
+        inner = children[level][node[~whole]]
+        who = np.repeat(who[~whole], 4)[inner.ravel() >= 0]
+        node = inner[inner >= 0]
+
+    return forces
+
+
+class ForceLayout:
+    """
+    A force-directed layout of the states of an automaton, which moves the states a step at a time,
+    so it can be shown as it settles
+    """
+    def __init__(self, automaton, spacing=150, steps=200, theta=1.0):
+        """
+        :param automaton: the automaton to lay out, starting from where its states are
+        :param spacing: the distance states connected by a transition settle at
+        :param steps: the most steps taken before the layout stops
+        :param theta: how exact pushing is worked out, see repulsion
+        """
+        self.automaton = automaton
+        self.spacing = spacing
+        self.steps = steps
+        self.theta = theta
+        self.step_count = 0
+        self.done = False
+
+        self.labels = list(automaton.states)
+        number = {label: i for i, label in enumerate(self.labels)}
+        self.points = np.array([automaton.states[label] for label in self.labels], dtype=float).reshape(-1, 2)
+        # Move states that are on top of each other apart a little, so they have a direction to be pushed in
+        self.points += np.random.default_rng(0).uniform(-1, 1, self.points.shape)
+
+        # Every two states connected by one or more transitions, once
+        pairs = {tuple(sorted((number[s], number[e]))) for s, _, e in automaton.transitions
+                 if s != e and s in number and e in number}
+        self.edges = np.array(sorted(pairs), dtype=np.intp).reshape(-1, 2)
+
+        # How far a state may move in a step, which shrinks as the layout cools down
+        self.start_temperature = spacing * max(1.0, math.sqrt(len(self.labels)) / 2)
+
+    def forces(self):
+        """
+        :return: the force on every state
+        """
+        points = self.points
+        forces = repulsion(points, self.spacing ** 2, self.theta, self.spacing * 0.6)
+
+        # Transitions pull with a force of distance^2 / spacing
+        first, second = self.edges[:, 0], self.edges[:, 1]
+        offset = points[second] - points[first]
+        pull = offset * (np.hypot(offset[:, 0], offset[:, 1]) / self.spacing)[:, None]
+        n = len(points)
+        for axis in range(2):
+            forces[:, axis] += np.bincount(first, pull[:, axis], n) - np.bincount(second, pull[:, axis], n)
+
+        # A slight pull towards the middle keeps parts that aren't connected from drifting off
+        forces -= (points - points.mean(axis=0)) * (0.01 * self.spacing / max(1.0, math.sqrt(n)))
+        return forces
+
+    def step(self):
+        """
+        Move every state once along the force on it
+
+        :return: True if the layout is still moving
+        """
+        if self.done or len(self.points) < 2:
+            self.done = True
+            return False
+
+        temperature = self.start_temperature * (1 - self.step_count / self.steps)
+        forces = self.forces()
+        length = np.maximum(np.hypot(forces[:, 0], forces[:, 1]), 1e-9)
+        moves = forces * (np.minimum(length, temperature) / length)[:, None]
+        self.points += moves
+
+        self.step_count += 1
+        # Stop when it runs out of steps, or when no state moves more than half a pixel anymore
+        self.done = self.step_count >= self.steps or np.abs(moves).max() < 0.5
+        return not self.done
+
+    def run(self):
+        """
+        Take steps until the layout has settled
+        """
+        while self.step():
+            pass
+
+    def positions(self):
+        """
+        :return: a dict from every state to its current position, rounded to whole pixels
+        """
+        return {label: (round(x), round(y)) for label, (x, y) in zip(self.labels, self.points.tolist())}
+
+    def apply(self):
+        """
+        Move the states of the automaton to where the layout has them, and once it has settled,
+        curve the transitions so the ones between the same states don't overlap
+        """
+        for label, pos in self.positions().items():
+            if label in self.automaton.states and self.automaton.states[label] != pos:
+                self.automaton.move_state(label, pos)
+        if self.done:
+            bend_transitions(self.automaton)
+
+
+def force_layout(automaton, spacing=150):
+    """
+    Lay out the states of an automaton with forces until they have settled, and curve its transitions
+
+    :param automaton: the automaton
+    :param spacing: the distance states connected by a transition settle at
+    """
+    layout = ForceLayout(automaton, spacing)
+    layout.run()
+    layout.apply()
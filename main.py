@@ -32,7 +32,8 @@ if __name__ == "__main__":
         # Call the necessary scene functions of the active scene
         director.scene.handle_events(pygame.event.get())
         director.scene.update()
-        director.scene.render(surface)
+        rects = director.scene.render(surface)
 
-        # Draw the surface to the screen
-        pygame.display.flip()
+        # Draw the parts of the surface that changed to the screen, if any
+        if rects:
+            pygame.display.update(rects)
@@ -0,0 +1,244 @@
+from collections import OrderedDict
+
+from algorithm import alphabet, bend_transitions, deterministic_automaton, grid_positions, layered_positions
+
+# This module compiles regular expressions into automata:
+# the pattern is parsed, turned into a nondeterministic automaton by Thompson's construction,
+# made deterministic by subset construction, and finally minimized.
+#
+# Syntax, over the symbols of 'alphabet':
+#   ab       - concatenation
+#   a|b      - either side (a side may be empty)
+#   a* a+ a? - zero or more, one or more, zero or one
+#   (a)      - grouping
+#   .        - any symbol
+#   [a-f0]   - any of the symbols in the brackets, with ranges
+
+
+# Yield the positions of the set bits of an integer
+def bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class RegexError(Exception):
+    def __init__(self, message, position):
+        super().__init__(f"{message} at position {position}")
+        self.position = position
+
+
+class Thompson:
+    """
+    A nondeterministic automaton built by Thompson's construction, out of fragments with one start and one end state
+    """
+    def __init__(self):
+        # For every state, a list of (symbols, target) tuples, where symbols is None for an epsilon transition
+        self.edges = []
+
+    def state(self):
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def symbols(self, symbols):
+        start, end = self.state(), self.state()
+        self.edges[start].append((frozenset(symbols), end))
+        return start, end
+
+    def empty(self):
+        start, end = self.state(), self.state()
+        self.edges[start].append((None, end))
+        return start, end
+
+    def concatenate(self, first, second):
+        self.edges[first[1]].append((None, second[0]))
+        return first[0], second[1]
+
+    def alternate(self, first, second):
+        start, end = self.state(), self.state()
+        for fragment in (first, second):
+            self.edges[start].append((None, fragment[0]))
+            self.edges[fragment[1]].append((None, end))
+        return start, end
+
+    def repeat(self, fragment, least_once, most_once):
+        start, end = self.state(), self.state()
+        self.edges[start].append((None, fragment[0]))
+        self.edges[fragment[1]].append((None, end))
+        if not least_once:
+            self.edges[start].append((None, end))
+        if not most_once:
+            self.edges[fragment[1]].append((None, fragment[0]))
+        return start, end
+
+
+class Parser:
+    """
+    A recursive descent parser building the Thompson automaton of a pattern as it goes
+    """
+    def __init__(self, pattern, symbols):
+        self.pattern = pattern
+        self.symbols = symbols
+        self.pos = 0
+        self.nfa = Thompson()
+
+    def peek(self):
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def parse(self):
+        fragment = self.expression()
+        if self.pos < len(self.pattern):
+            raise RegexError(f"Unexpected '{self.peek()}'", self.pos)
+        return fragment
+
+    def expression(self):
+        fragment = self.term()
+        while self.peek() == "|":
+            self.pos += 1
+            fragment = self.nfa.alternate(fragment, self.term())
+        return fragment
+
+    def term(self):
+        fragment = None
+        while self.peek() is not None and self.peek() not in "|)":
+            factor = self.factor()
+            fragment = factor if fragment is None else self.nfa.concatenate(fragment, factor)
+        return self.nfa.empty() if fragment is None else fragment
+
+    def factor(self):
+        fragment = self.atom()
+        while (c := self.peek()) is not None and c in "*+?":
+            self.pos += 1
+            fragment = self.nfa.repeat(fragment, least_once=c == "+", most_once=c == "?")
+        return fragment
+
+    def atom(self):
+        c = self.peek()
+        start = self.pos
+        self.pos += 1
+
+        if c == "(":
+            fragment = self.expression()
+            if self.peek() != ")":
+                raise RegexError("Missing ')'", self.pos)
+            self.pos += 1
+            return fragment
+        if c == ".":
+            return self.nfa.symbols(self.symbols)
+        if c == "[":
+            return self.nfa.symbols(self.group())
+        if c in self.symbols:
+            return self.nfa.symbols(c)
+        raise RegexError(f"Unexpected '{c}'", start)
+
+    def group(self):
+        start = self.pos - 1
+        chosen = set()
+
+        while (c := self.peek()) != "]":
+            if c is None:
+                raise RegexError("Missing ']'", start)
+            if c not in self.symbols:
+                raise RegexError(f"Unknown symbol '{c}'", self.pos)
+            self.pos += 1
+
+            # A range of symbols, in the order of the alphabet
+            if self.peek() == "-" and self.pos + 1 < len(self.pattern) and self.pattern[self.pos + 1] != "]":
+                last = self.pattern[self.pos + 1]
+                if last not in self.symbols or self.symbols.index(last) < self.symbols.index(c):
+                    raise RegexError(f"Invalid range '{c}-{last}'", self.pos - 1)
+                chosen.update(self.symbols[self.symbols.index(c):self.symbols.index(last) + 1])
+                self.pos += 2
+            else:
+                chosen.add(c)
+
+        self.pos += 1
+        if not chosen:
+            raise RegexError("Empty brackets", start)
+        return chosen
+
+
+def determinize(nfa, start, accept, symbols):
+    """
+    Subset construction of a Thompson automaton, with sets of states stored as bitsets
+
+    :param nfa: the Thompson automaton
+    :param start: the starting state
+    :param accept: the accepting state
+    :param symbols: the symbols to follow
+    :return: for every deterministic state a dict from symbol to state number, and the accepting state numbers
+    """
+    # The states reachable from every state through epsilon transitions alone
+    closures = []
+    for s in range(len(nfa.edges)):
+        closure = 1 << s
+        todo = [s]
+        while todo:
+            for on, e in nfa.edges[todo.pop()]:
+                if on is None and not closure >> e & 1:
+                    closure |= 1 << e
+                    todo.append(e)
+        closures.append(closure)
+
+    found = {closures[start]: 0}
+    sets = [closures[start]]
+    edges = []
+    acceptors = []
+
+    for i, current in enumerate(sets):
+        if current >> accept & 1:
+            acceptors.append(i)
+
+        targets = {}
+        for s in bits(current):
+            for on, e in nfa.edges[s]:
+                if on is not None:
+                    for symbol in on:
+                        targets[symbol] = targets.get(symbol, 0) | closures[e]
+
+        row = {}
+        for symbol in symbols:
+            if symbol in targets:
+                if targets[symbol] not in found:
+                    found[targets[symbol]] = len(sets)
+                    sets.append(targets[symbol])
+                row[symbol] = found[targets[symbol]]
+        edges.append(row)
+
+    return edges, acceptors
+
+
+# Compiled patterns, most recently used last
+cache = OrderedDict()
+cache_size = 64
+
+
+def compile_regex(pattern, symbols=alphabet):
+    """
+    Build the minimal deterministic automaton accepting exactly the strings matching a regular expression,
+    with its states laid out from left to right. Results are cached, so recompiling a pattern is cheap
+
+    :param pattern: the regular expression
+    :param symbols: the symbols a pattern may consist of
+    :return: the automaton
+    """
+    key = (pattern, symbols)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key].copy()
+
+    parser = Parser(pattern, symbols)
+    start, accept = parser.parse()
+    edges, acceptors = determinize(parser.nfa, start, accept, symbols)
+
+    dfa = deterministic_automaton([None] * len(edges), grid_positions(len(edges)), edges, 0, acceptors)
+    automaton = dfa.minimize()
+    for label, pos in layered_positions(automaton).items():
+        automaton.add_state(label, pos)
+    bend_transitions(automaton)
+
+    cache[key] = automaton
+    if len(cache) > cache_size:
+        cache.popitem(last=False)
+    return automaton.copy()
@@ -1,17 +1,38 @@
 import pygame
 import pygame.gfxdraw
+import heapq
 import math
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from algorithm import *
+from fsaformat import BinaryFormatError, FSAParseError
+from layout import ForceLayout
+from regexp import compile_regex, RegexError
 from uielements import *
 
 
 # Constants
 backgroundColor = (220, 220, 220)
 black = (0, 0, 0)
-alphabet = "0123456789abcdefghijklmnopqrstuvwxyz"
-resultColors = {"Accepted": (0, 155, 0), "Declined": (255, 0, 0), "No Start": (0, 0, 255)}
+playbackColor = (255, 140, 0)
+resultColors = {"Accepted": (0, 155, 0), "Declined": (255, 0, 0), "No Start": (0, 0, 255), "Bad Regex": (0, 0, 255)}
+# Below this zoom, transition values aren't drawn
+labelZoom = 0.5
+# How far a transition value may stick out of the arrow on the screen, for finding what to redraw
+labelMargin = 150
+# Seconds between autosaves, which only happen when the automaton changed since it was last saved or loaded
+autosaveInterval = 30
+# Seconds spent on moving the states of an automatic layout every frame, so the window keeps responding
+layoutTime = 0.01
+# The speeds a run can be played back at, in steps per second
+playbackSpeeds = (1, 2, 4, 8, 16, 64, 256, 1024)
+# Seconds spent on running test strings every frame, and the number of cases listed on the screen
+testTime = 0.01
+testRows = 22
+testColors = {"pass": (0, 155, 0), "fail": (255, 0, 0), "pending": (130, 130, 130)}
 
 
 # Main Classes:
@@ -73,6 +94,7 @@ class Scene:
         Draw to the given surface
 
         :param surface: the surface to draw to
+        :return: the rects of the surface that changed
         """
         # Clear screen
         surface.fill(backgroundColor)
@@ -81,6 +103,8 @@ class Scene:
         for element in self.ui.values():
             surface.blit(element.render(), element.rect.topleft)
 
+        return [surface.get_rect()]
+
     def switch(self, scene, args=None):
         """
         Calls for its director to switch to the given scene. Applies the args to the scene
@@ -121,7 +145,7 @@ class MenuScene(Scene):
         super().handle_events(events)
 
     def render(self, surface):
-        super().render(surface)
+        return super().render(surface)
 
 
 class SimulateScene(Scene):
@@ -130,17 +154,56 @@ class SimulateScene(Scene):
     """
     def __init__(self):
         super().__init__()
+        # The test strings checked against the automaton as it is edited
+        self.tests = TestSuite()
         self.ui = {
             'input': TextBox(pygame.Rect(1030, 660, 190, 30)),
             'run': Button(pygame.Rect(1230, 660, 60, 30), "RUN", [self.run], [], self),
+            'regex': Button(pygame.Rect(940, 660, 80, 30), "REGEX", [self.regex], [], self),
             'filename': TextBox(pygame.Rect(10, 10, 250, 30)),
             'save': Button(pygame.Rect(10, 50, 70, 30), "SAVE", [self.save], [], self),
-            'load': Button(pygame.Rect(90, 50, 70, 30), "LOAD", [self.load], [], self)
+            'load': Button(pygame.Rect(90, 50, 70, 30), "LOAD", [self.load], [], self),
+            'tests': Button(pygame.Rect(1200, 540, 90, 30), "TESTS", [self.load_tests], [], self),
+            'accept': Button(pygame.Rect(1030, 580, 80, 30), "+ACC", [self.add_test], ["Accepted"], self),
+            'decline': Button(pygame.Rect(1115, 580, 80, 30), "+DEC", [self.add_test], ["Declined"], self),
+            'clear': Button(pygame.Rect(1200, 580, 90, 30), "CLEAR", [self.tests.clear], [], self)
+        }
+        # The controls for playing back the last run, which are only shown once there is one
+        self.controls = {
+            'seek': SeekBar(pygame.Rect(480, 625, 450, 25), self.seek, self),
+            'first': Button(pygame.Rect(480, 660, 40, 30), "|<", [self.seek], [0], self),
+            'back': Button(pygame.Rect(525, 660, 40, 30), "<", [self.step_by], [-1], self),
+            'play': Button(pygame.Rect(570, 660, 80, 30), "PLAY", [self.toggle_play], [], self),
+            'forward': Button(pygame.Rect(655, 660, 40, 30), ">", [self.step_by], [1], self),
+            'last': Button(pygame.Rect(700, 660, 40, 30), ">|", [self.seek], [1], self),
+            'speed': Button(pygame.Rect(745, 660, 90, 30), f"{playbackSpeeds[0]}/s", [self.change_speed], [], self)
         }
         self.selected = None
         self.selectedT = None
         self.arrow = None
         self.automaton = Automaton()
+        self.camera = Camera()
+        # The last mouse position while the view is being dragged
+        self.panning = None
+        # The automatic layout being shown as it settles, if any
+        self.layout = None
+        # For every transition, the geometry of its arrow and the positions and force vector it was worked out from
+        self.geometries = {}
+        # Grids of the states and transitions for finding what was clicked, and the automaton and version they hold
+        self.grids = None
+        self.gridded = (None, None)
+        # The coordinates of the states other than the dragged one for snapping to,
+        # with the automaton, the dragged state and the version they were taken from
+        self.snaps = None
+
+        # The diagram without the selection, drawn once and reused until something else changes
+        self.layer = None
+        # A surface the size of the layer that strips of it are drawn on before they are copied over
+        self.strip = None
+        self.layered = None
+        # The rects drawn over the layer in the last frame, and everything that the last frame looked like
+        self.overlay = []
+        self.drawn = None
 
         self.drag = 0
         self.dragpos = (0, 0)
@@ -150,53 +213,61 @@ class SimulateScene(Scene):
         self.result = None
         self.fileresult = None
 
+        # The trace of the last string run, the step of it shown, whether it is playing and at which of the speeds,
+        # and the time the step shown was last moved along
+        self.trace = None
+        self.step = 0
+        self.playing = False
+        self.speed = 0
+        self.played = 0
+
+        # Files are saved and loaded one at a time on a worker thread, so big automata don't freeze the window
+        self.files = ThreadPoolExecutor(max_workers=1)
+        self.job = None
+        self.progress = None
+        # File jobs asked for while another one was running, started in order once it is done
+        self.queued = deque()
+        self.untitled = 1
+        # The automaton and its version when it was last saved or loaded, to tell whether it has changed since
+        self.saved = (self.automaton, self.automaton.version)
+        self.autosaved = time.monotonic()
+
     def handle_events(self, events):
         super().handle_events(events)
+        if self.trace is not None:
+            for element in self.controls.values():
+                element.handle_events(events)
 
         pos = pygame.mouse.get_pos()
         self.mousepos = pos
+        # The position of the mouse in the diagram, and how far that is from it in the diagram at 1 px on the screen
+        world = self.camera.to_world(pos)
+        pixel = 1 / self.camera.zoom
 
         for event in events:
             # Check if the left mouse button is down
             if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
                 found = False
+                states, transitions = self.hit_grids()
                 # Check if the mouse click happened on a transition arrow
-                for (s, v), (e, m) in self.automaton.transitions.items():
-                    a = self.automaton.states[s]
-                    b = self.automaton.states[e]
-                    c, r = circle_from_3_points(a, mid := from_vector(a, b, m), b)
-
-                    # Check if the arrow is curved
-                    if c is not None:
-                        s_angle, e_angle, rev = adjusted_angles(a, mid, b)
-                        polygon = arc_to_polygon(c, r, 3, s_angle, e_angle, not rev)
-
-                        for p in polygon:
-                            if math.dist(p, pos) < 5 and self.arrow is None:
-                                self.selected = None
-                                self.selectedT = (s, v)
-                                found = True
-                                self.drag = 1
-                                self.dragpos = pos
-                                break
-                    else:
-                        self.automaton.transitions[(s, v)] = (e, (0, 0))
-                        if point_to_segment(pos, a, b) < 7 and self.arrow is None:
-                            self.selected = None
-                            self.selectedT = (s, v)
-                            found = True
-                            self.drag = 1
-                            self.dragpos = pos
-                            break
+                near = (world[0] - 7 * pixel, world[1] - 7 * pixel, world[0] + 7 * pixel, world[1] + 7 * pixel)
+                for transition in transitions.query_box(near):
+                    if self.geometry(transition).hit(world, pixel) and self.arrow is None:
+                        self.selected = None
+                        self.selectedT = transition
+                        found = True
+                        self.drag = 1
+                        self.dragpos = pos
+                        break
                 # Check if the mouse click happened inside a state circle
-                for s in self.automaton.states:
-                    if math.dist(self.automaton.states[s], pos) < 30:
+                for s in states.query(world):
+                    if math.dist(self.automaton.states[s], world) < 30:
                         # Check if an arrow connection is being made
                         if self.arrow is not None:
-                            # Add a transition to the automaton, using the first unused bridging value in 'alphabet'
+                            # Add a transition to the automaton, using the first value in 'alphabet' the state doesn't read yet
                             val = '0'
                             for a in alphabet:
-                                if (self.selected, a) not in self.automaton.transitions:
+                                if a not in self.automaton.index.get(self.selected, {}):
                                     val = a
                                     break
                             vector = (60, 0.5*math.pi) if self.selected == s else (0, 0)
@@ -218,10 +289,21 @@ class SimulateScene(Scene):
                         i = 0
                         while (lbl := f"q{i}") in self.automaton.states.keys():
                             i += 1
-                        self.automaton.states[lbl] = pygame.mouse.get_pos()
+                        self.automaton.add_state(lbl, (round(world[0]), round(world[1])))
+            # Drag the view around with the right mouse button
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
+                self.panning = pos
+            elif event.type == pygame.MOUSEMOTION and self.panning is not None:
+                self.camera.pan(event.pos[0] - self.panning[0], event.pos[1] - self.panning[1])
+                self.panning = event.pos
+            # Zoom in and out around the mouse with the scroll wheel
+            elif event.type == pygame.MOUSEWHEEL:
+                self.camera.zoom_at(pos, 1.1 ** event.y)
             elif event.type == pygame.MOUSEBUTTONUP:
                 # Stop the dragging state when the left mouse button is released
                 self.drag = 0
+                if event.button == 3:
+                    self.panning = None
             # Check if the 'a' key was pressed, and if so, toggle the selected state being an acceptor
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_a and self.selected is not None:
                 if self.selected not in self.automaton.acceptors:
@@ -235,32 +317,48 @@ class SimulateScene(Scene):
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_h\
                     and self.selected is None and self.selectedT is None:
                 self.help = not self.help
+            # Go back to the original view
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_HOME:
+                self.camera = Camera()
+            # Replace the automaton with its minimized version
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_m\
+                    and self.selected is None and self.selectedT is None and not self.typing():
+                try:
+                    self.automaton = self.automaton.minimize()
+                except StartError:
+                    self.result = "No Start"
+            # Start laying out the states automatically, or stop where it is
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_l\
+                    and self.selected is None and self.selectedT is None and not self.typing():
+                if self.layout is None:
+                    self.layout = ForceLayout(self.automaton)
+                else:
+                    self.layout.done = True
+                    self.layout.apply()
+                    self.layout = None
+            # Play back the last run, or step through it
+            elif event.type == pygame.KEYDOWN and event.key in (pygame.K_SPACE, pygame.K_LEFT, pygame.K_RIGHT)\
+                    and self.trace is not None and not self.typing():
+                if event.key == pygame.K_SPACE:
+                    self.toggle_play()
+                else:
+                    self.step_by(1 if event.key == pygame.K_RIGHT else -1)
             # Change the bridging value of the transition
             elif event.type == pygame.KEYDOWN and self.selectedT is not None:
                 if event.key == pygame.K_COMMA:
                     for a in alphabet:
                         if a not in self.selectedT[1].split(','):
-                            e, m = self.automaton.transitions[self.selectedT]
-                            self.automaton.remove_transition(self.selectedT)
-                            new_v = self.selectedT[1] + f",{a}"
-                            self.automaton.add_transition(self.selectedT[0], e, new_v, force_vector=m)
-                            self.selectedT = (self.selectedT[0], new_v)
+                            self.relabel(self.selectedT[1] + f",{a}")
                             break
                 elif event.key == pygame.K_BACKSPACE:
                     if len(spl := self.selectedT[1].split(',')) > 1:
-                        e, m = self.automaton.transitions[self.selectedT]
-                        self.automaton.remove_transition(self.selectedT)
-                        new_v = ','.join(spl[:-1])
-                        self.automaton.add_transition(self.selectedT[0], e, new_v, force_vector=m)
-                        self.selectedT = (self.selectedT[0], new_v)
+                        self.relabel(','.join(spl[:-1]))
+                elif event.key == pygame.K_PERIOD:
+                    self.relabel(','.join(self.selectedT[1].split(',')[:-1] + [EPSILON]))
                 else:
                     for a in alphabet:
                         if pygame.key.get_pressed()[getattr(pygame, f"K_{a}")]:
-                            e, m = self.automaton.transitions[self.selectedT]
-                            self.automaton.remove_transition(self.selectedT)
-                            new_v = ','.join(self.selectedT[1].split(',')[:-1] + [a])
-                            self.automaton.add_transition(self.selectedT[0], e, new_v, force_vector=m)
-                            self.selectedT = (self.selectedT[0], new_v)
+                            self.relabel(','.join(self.selectedT[1].split(',')[:-1] + [a]))
                             break
 
         # If 10 frames of holding the mouse down have passed,
@@ -271,29 +369,23 @@ class SimulateScene(Scene):
         elif self.drag == 11:
             # Move the state to where the mouse is positioned if the selected element is a state
             if self.selected is not None:
-                hor = pos[0]
-                ver = pos[1]
-
-                # Check if a state should snap horizontally/vertically to another state
-                without_self = [v for k, v in self.automaton.states.items() if k != self.selected]
-                for (h, _) in without_self:
-                    if abs(h - pos[0]) <= 5:
-                        hor = h
-                        break
-                for (_, v) in without_self:
-                    if abs(v - pos[1]) <= 5:
-                        ver = v
-                        break
-                self.automaton.states[self.selected] = (hor, ver)
+                # Check if a state should snap horizontally/vertically to the nearest other state
+                others = self.snap_index()
+                hor = others.nearest_x(world[0], 5 * pixel)
+                ver = others.nearest_y(world[1], 5 * pixel)
+                hor = round(world[0]) if hor is None else hor
+                ver = round(world[1]) if ver is None else ver
+                self.edit_active(self.automaton.move_state, self.selected, (hor, ver))
+                # Moving the dragged state leaves the coordinates of the others as they are
+                self.snaps = (self.snaps[0], self.automaton.version, others)
             # Otherwise, curve the selected arrow to the mouse position
             elif self.selectedT is not None:
-                s, v = self.selectedT
-                e, _ = self.automaton.transitions[self.selectedT]
+                s, v, e = self.selectedT
                 if s == e:
-                    mid = (60, get_angle(self.mousepos, self.automaton.states[s]))
+                    mid = (60, get_angle(world, self.automaton.states[s]))
                 else:
-                    mid = vectorize(self.automaton.states[s], self.mousepos, self.automaton.states[e])
-                self.automaton.transitions[(s, v)] = (e, mid)
+                    mid = vectorize(self.automaton.states[s], world, self.automaton.states[e])
+                self.edit_active(self.automaton.bend_transition, self.selectedT, mid)
         elif 0 < self.drag < 10:
             self.drag += 1
 
@@ -314,122 +406,628 @@ class SimulateScene(Scene):
         else:
             self.arrow = None
 
+    def update(self):
+        # Move the states a few steps further along the layout, unless they're being moved by hand or were replaced
+        if self.layout is not None:
+            if self.layout.automaton is not self.automaton or self.drag == 11:
+                self.layout = None
+            else:
+                deadline = time.monotonic() + layoutTime
+                while self.layout.step() and time.monotonic() < deadline:
+                    pass
+                self.layout.apply()
+                if self.layout.done:
+                    self.layout = None
+
+        # Move the playback along by the steps it should have taken since the last one, or drop it once the
+        # transitions it was run on have changed
+        if self.trace is not None:
+            if self.trace.automaton is not self.automaton or self.trace.stale():
+                self.trace = None
+                self.playing = False
+            elif self.playing and (steps := int((time.monotonic() - self.played) * playbackSpeeds[self.speed])):
+                self.played += steps / playbackSpeeds[self.speed]
+                self.show_step(self.step + steps)
+
+        # Run the test strings whose results may have changed since the last frame, for as long as there is time
+        self.tests.update(self.automaton)
+        self.tests.run(time.monotonic() + testTime)
+
+        # Finish the file job once the worker is done with it
+        if self.job is not None and self.job[0].done():
+            future, finish, _ = self.job
+            self.job = None
+            self.progress = None
+            finish(future)
+            if self.queued:
+                self.submit(*self.queued.popleft())
+        elif self.job is None and time.monotonic() - self.autosaved > autosaveInterval and self.changed():
+            self.autosave()
+
     def render(self, surface):
-        super().render(surface)
+        # Leave the screen alone when nothing changed since the last frame
+        look = self.look()
+        if look == self.drawn:
+            return []
+        self.drawn = look
+
+        if self.layered != (key := self.layer_key()):
+            self.update_layer(surface.get_size(), key)
+            surface.blit(self.layer, (0, 0))
+            changed = [surface.get_rect()]
+        else:
+            # Wipe what was drawn over the layer in the last frame
+            for rect in self.overlay:
+                surface.blit(self.layer, rect, rect)
+            changed = self.overlay
 
-        text(surface, ".fsa", (265, 20), regularfont, black)
+        self.overlay = [rect.inflate(4, 4) for rect in self.draw_overlay(surface)]
+        return changed + self.overlay
+
+    def look(self):
+        """
+        Everything that decides what a frame looks like
+
+        :return: a tuple that is equal for frames that look the same
+        """
+        return (self.automaton, self.automaton.version, self.selected, self.selectedT, self.camera.key(), self.arrow,
+                self.help, self.result, self.fileresult, self.progress, self.trace, self.step,
+                self.tests.version, [element.appearance() for element in self.ui.values()],
+                [element.appearance() for element in self.controls.values()] if self.trace is not None else None)
+
+    def layer_key(self):
+        return self.automaton, self.automaton.version, self.selected, self.selectedT, self.camera.key()
+
+    def active(self):
+        """
+        Get the elements drawn over the layer, because they are selected or move along with the selected state
+
+        :return: the set of active states and the set of active transitions
+        """
+        if self.selected is not None:
+            return {self.selected}, {(s, v, e) for s, v, e in self.automaton.transitions if self.selected in (s, e)}
+        if self.selectedT is not None:
+            return set(), {self.selectedT}
+        return set(), set()
+
+    def edit_active(self, change, *args):
+        """
+        Make a change to the automaton that only affects the active elements, which keeps the layer
+
+        :param change: the method of the automaton making the change
+        :param args: the arguments of the change
+        """
+        fresh = self.layered == self.layer_key()
+        change(*args)
+        if fresh:
+            self.layered = self.layer_key()
+
+    def update_layer(self, size, key):
+        """
+        Bring the layer up to date. When only the view moved, the layer is scrolled along
+        and only the uncovered strips are drawn
+
+        :param size: the size of the screen
+        :param key: the layer key to bring it up to
+        """
+        width, height = size
+        if self.layered is not None and self.layered[:4] == key[:4] and self.layered[4][2] == key[4][2]\
+                and self.layer.get_size() == size:
+            dx = self.layered[4][0] - key[4][0]
+            dy = self.layered[4][1] - key[4][1]
+            if abs(dx) < width and abs(dy) < height:
+                self.layered = key
+                self.layer.scroll(dx, dy)
+                if dx:
+                    self.draw_layer(pygame.Rect(0 if dx > 0 else width + dx, 0, abs(dx), height))
+                if dy:
+                    self.draw_layer(pygame.Rect(0, 0 if dy > 0 else height + dy, width, abs(dy)))
+                # Lines cut off at the edge of the layer are drawn a little differently than whole ones,
+                # so everything cut off before or after scrolling is drawn again
+                for rect in self.cut_off(pygame.Rect(max(dx, 0), max(dy, 0), width - abs(dx), height - abs(dy))):
+                    self.draw_layer(rect)
+                return
+
+        if self.layer is None or self.layer.get_size() != size:
+            self.layer = pygame.Surface(size)
+            self.strip = pygame.Surface(size)
+        self.layered = key
+        self.draw_layer(self.layer.get_rect())
+
+        # Forget the geometry of transitions that no longer exist
+        if len(self.geometries) > len(self.automaton.transitions):
+            self.geometries = {t: g for t, g in self.geometries.items() if t in self.automaton.transitions}
+
+    def cut_off(self, kept):
+        """
+        Find the parts of the layer covered by the elements crossing the edges of a rect
+
+        :param kept: the rect of the layer that was drawn the same before and after scrolling
+        :return: a rect of the layer for every edge crossed by elements, covering those elements
+        """
+        states, transitions = self.hit_grids()
+        pixel = 1 / self.camera.zoom
+        margin = 5 * pixel
+        rects = []
+        edges = (pygame.Rect(kept.left, kept.top, kept.width, 1), pygame.Rect(kept.left, kept.bottom - 1, kept.width, 1),
+                 pygame.Rect(kept.left, kept.top, 1, kept.height), pygame.Rect(kept.right - 1, kept.top, 1, kept.height))
+        for edge in edges:
+            left, top, right, bottom = self.camera.view(edge)
+            boxes = [self.geometry(t).box for t in
+                     transitions.query_box((left - margin, top - margin, right + margin, bottom + margin))]
+            # States only draw the lines showing the starting state outside of their circle
+            for s in states.query_box((left - 45, top - 45, right + 45, bottom + 45)):
+                x, y = self.automaton.states[s]
+                boxes.append((x - 45, y - 45, x + 45, y + 45))
+            if not boxes:
+                continue
+
+            left, top = self.camera.to_screen((min(box[0] for box in boxes), min(box[1] for box in boxes)))
+            right, bottom = self.camera.to_screen((max(box[2] for box in boxes), max(box[3] for box in boxes)))
+            rect = pygame.Rect(math.floor(left) - 5, math.floor(top) - 5, math.ceil(right - left) + 10,
+                               math.ceil(bottom - top) + 10).clip(self.layer.get_rect())
+            if rect:
+                rects.append(rect)
+        return rects
+
+    def draw_layer(self, rect):
+        """
+        Draw the part of the diagram in a rect of the layer, leaving out the active elements.
+        Only the elements near the rect are looked at. They are drawn without clipping, as clipping a line
+        changes which pixels it covers, so a part of the layer is drawn on another surface and copied over
+
+        :param rect: the rect on the screen
+        """
+        surface = self.layer if rect == self.layer.get_rect() else self.strip
+        surface.fill(backgroundColor, rect)
+
+        # Find the elements near the rect, leaving room for the parts drawn around them
+        states, transitions = self.hit_grids()
+        pixel = 1 / self.camera.zoom
+        left, top, right, bottom = self.camera.view(rect)
+        # Leaving room for rounding as well, and for how thick lines are at least
+        margin = 15 + 3 * pixel + (labelMargin * pixel if self.camera.zoom >= labelZoom else 0)
+        state_margin = 45 + 3 * pixel
+
+        active_states, active_transitions = self.active()
+        for s in states.query_box((left - state_margin, top - state_margin, right + state_margin, bottom + state_margin)):
+            if s not in active_states:
+                self.draw_state(surface, s)
+        shown = [t for t in transitions.query_box((left - margin, top - margin, right + margin, bottom + margin))
+                 if t not in active_transitions]
+        geometries = [self.geometry(t) for t in shown]
+        # Work out the outlines of all curved arrows that aren't known at this level of detail together
+        curved = [g for g in geometries if g.curved]
+        batch_outlines(curved, [self.camera.segments(g.radius) for g in curved])
+        for transition, geometry in zip(shown, geometries):
+            self.draw_transition(surface, transition, geometry)
+
+        if surface is self.strip:
+            self.layer.blit(self.strip, rect, rect)
+
+    def draw_overlay(self, surface):
+        """
+        Draw everything that isn't part of the layer
+
+        :param surface: the surface to draw to
+        :return: the rects drawn to
+        """
+        rects = []
+
+        states, transitions = self.active()
+        for s in states:
+            rects.append(self.draw_state(surface, s))
+        for transition in transitions:
+            rects.append(self.draw_transition(surface, transition))
+
+        # Highlight the states the playback is in, and the transitions taken to get there
+        if self.trace is not None:
+            for transition in self.trace.transitions_at(self.step):
+                rects.append(self.draw_transition(surface, transition, color=playbackColor))
+            for s in self.trace.states_at(self.step):
+                rects.append(self.draw_state(surface, s, playbackColor))
+
+        for element in self.ui.values():
+            rects.append(surface.blit(element.render(), element.rect.topleft))
+
+        if self.trace is not None:
+            for element in self.controls.values():
+                rects.append(surface.blit(element.render(), element.rect.topleft))
+            rects.append(text(surface, f"Step {self.step} of {len(self.trace)}", (480, 600), regularfont, black))
+
+        rects.append(text(surface, ".fsa", (265, 20), regularfont, black))
+
+        if self.tests.cases:
+            rects += self.draw_tests(surface)
+
+        # Show how far along the file job is, or how the last one went
+        if self.progress is not None:
+            rects.append(text(surface, f"{self.job[2]}... {int(self.progress * 100)}%", (170, 57), regularfont, black))
+        elif self.fileresult is not None:
+            rects.append(text(surface, self.fileresult, (170, 57), regularfont, black))
 
         # Show instructions on screen
         if self.help:
-            text(surface, "crtl + click  - Create state", (20, 550), regularfont, black)
-            text(surface, "shift + click - Create transition", (20, 570), regularfont, black)
-            text(surface, "a             - Toggle acceptor", (20, 590), regularfont, black)
-            text(surface, "s             - Set starting state", (20, 610), regularfont, black)
-            text(surface, "delete        - Delete selected state/transition", (20, 630), regularfont, black)
-            text(surface, ",             - Add multiple transitional values", (20, 650), regularfont, black)
-            text(surface, "backspace     - Remove last value of transition", (20, 670), regularfont, black)
+            rects.append(text(surface, "crtl + click  - Create state", (20, 430), regularfont, black))
+            rects.append(text(surface, "shift + click - Create transition", (20, 450), regularfont, black))
+            rects.append(text(surface, "a             - Toggle acceptor", (20, 470), regularfont, black))
+            rects.append(text(surface, "s             - Set starting state", (20, 490), regularfont, black))
+            rects.append(text(surface, "delete        - Delete selected state/transition", (20, 510), regularfont, black))
+            rects.append(text(surface, ",             - Add multiple transitional values", (20, 530), regularfont, black))
+            rects.append(text(surface, "backspace     - Remove last value of transition", (20, 550), regularfont, black))
+            rects.append(text(surface, f".             - Make last value of transition {EPSILON}", (20, 570),
+                              regularfont, black))
+            rects.append(text(surface, "m             - Minimize the automaton", (20, 590), regularfont, black))
+            rects.append(text(surface, "l             - Lay out the states automatically", (20, 610), regularfont, black))
+            rects.append(text(surface, "space, arrows - Play / step through the last run", (20, 630), regularfont, black))
+            rects.append(text(surface, "right drag    - Move the view", (20, 650), regularfont, black))
+            rects.append(text(surface, "scroll / home - Zoom / reset the view", (20, 670), regularfont, black))
         else:
-            text(surface, "Press h to toggle help", (20, 670), regularfont, black)
+            rects.append(text(surface, "Press h to toggle help", (20, 670), regularfont, black))
 
         # Show the result of running the string
         if self.result is not None:
-            text(surface, self.result, (1030, 620), biggerfont, resultColors[self.result])
-
-        # Draw a circle for each state
-        for s in self.automaton.states:
-            color = (150, 150, 255) if s == self.selected else black
-            pygame.draw.circle(surface, color, self.automaton.states[s], 30, 3)
-            # Draw another smaller circle if the state is an accepting state
-            if s in self.automaton.acceptors:
-                pygame.draw.circle(surface, color, self.automaton.states[s], 22, 3)
-            # Draw two lines when the state is the starting state
-            if s == self.automaton.start:
-                startpos = (self.automaton.states[s][0] - 30, self.automaton.states[s][1])
-                endpos1 = (self.automaton.states[s][0] - 40, self.automaton.states[s][1] + 10)
-                endpos2 = (self.automaton.states[s][0] - 40, self.automaton.states[s][1] - 10)
-                pygame.draw.line(surface, color, startpos, endpos1, 3)
-                pygame.draw.line(surface, color, startpos, endpos2, 3)
-
-        # Draw an arrow for each transition
-        for (s, v), (e, m) in self.automaton.transitions.items():
-            start = self.automaton.states[s]
-            end = self.automaton.states[e]
-            mid = from_vector(start, end, m)
-
-            color = (150, 150, 255) if (s, v) == self.selectedT else black
-            path = draw_arc(surface, start, mid, end, color, return_path=True)
-
-            # Arrow head
-            center, radius = circle_from_3_points(start, mid, end)
-            if center is not None:
-                pathmid = len(path)//2
-                angle = get_angle(path[pathmid-2], path[pathmid-1])
-                adjusted_end = between(path[pathmid], path[pathmid-1], 0.5)
-            else:
-                angle = get_angle(start, end)
-                adjusted_end = (end[0] + math.cos(angle) * 30, end[1] + math.sin(angle) * 30)
-            arrow_l = (adjusted_end[0] + (math.cos(angle - 0.5) * 10),
-                       adjusted_end[1] + (math.sin(angle - 0.5) * 10))
-            arrow_r = (adjusted_end[0] + (math.cos(angle + 0.5) * 10),
-                       adjusted_end[1] + (math.sin(angle + 0.5) * 10))
-
-            pygame.draw.polygon(surface, color, [adjusted_end, arrow_l, arrow_r], width=0)
-
-            # Arrow value
-            if center is not None:
-                textmid = between(path[len(path)//4], path[3*len(path)//4], 0.5)
-            else:
-                textmid = between(start, end, 0.5)
-            txt, rect = regularfont.render(str(v), color)
-            rectc = (textmid[0] - rect.width // 2, textmid[1] - rect.height // 2)
-            pygame.draw.rect(surface, backgroundColor, pygame.Rect(rectc[0]-2, rectc[1]-2, rect.w+4, rect.h+4), 0)
-            surface.blit(txt, rectc)
+            rects.append(text(surface, self.result, (1030, 620), biggerfont, resultColors[self.result]))
 
         # Draw an arrow from the selected circle to the mouse when holding shift
         if self.arrow is not None:
-            # Similar to above
-            x = self.automaton.states[self.selected][0]
-            y = self.automaton.states[self.selected][1]
+            x, y = self.camera.to_screen(self.automaton.states[self.selected])
             angle = math.atan2(y - self.arrow[1], x - self.arrow[0])
-            adjusted_start = (x - (math.cos(angle) * 30), y - (math.sin(angle) * 30))
+            radius = 30 * self.camera.zoom
+            adjusted_start = (x - (math.cos(angle) * radius), y - (math.sin(angle) * radius))
             adjusted_end = (self.arrow[0] + (math.cos(angle) * 3), self.arrow[1] + (math.sin(angle) * 3))
-            pygame.draw.line(surface, black, adjusted_start, adjusted_end, 3)
+            rects.append(pygame.draw.line(surface, black, adjusted_start, adjusted_end, 3))
 
             # Arrow head
             arrow_l = (self.arrow[0] + (math.cos(angle - 0.5) * 10), self.arrow[1] + (math.sin(angle - 0.5) * 10))
             arrow_r = (self.arrow[0] + (math.cos(angle + 0.5) * 10), self.arrow[1] + (math.sin(angle + 0.5) * 10))
-            pygame.draw.polygon(surface, black, [self.arrow, arrow_l, arrow_r], width=0)
+            rects.append(pygame.draw.polygon(surface, black, [self.arrow, arrow_l, arrow_r], width=0))
+
+        return rects
+
+    def draw_state(self, surface, s, color=None):
+        """
+        Draw a state circle
+
+        :param surface: the surface to draw to
+        :param s: the label of the state
+        :param color: the color to draw it in, instead of the one showing whether it is selected
+        :return: the rect drawn to
+        """
+        zoom = self.camera.zoom
+        x, y = self.camera.to_screen(self.automaton.states[s])
+        width = max(1, round(3 * zoom))
+        if color is None:
+            color = (150, 150, 255) if s == self.selected else black
+        rect = pygame.draw.circle(surface, color, (x, y), 30 * zoom, width)
+        # Draw another smaller circle if the state is an accepting state
+        if s in self.automaton.acceptors:
+            pygame.draw.circle(surface, color, (x, y), 22 * zoom, width)
+        # Draw two lines when the state is the starting state
+        if s == self.automaton.start:
+            rect.union_ip(pygame.draw.line(surface, color, (x - 30 * zoom, y), (x - 40 * zoom, y + 10 * zoom), width))
+            rect.union_ip(pygame.draw.line(surface, color, (x - 30 * zoom, y), (x - 40 * zoom, y - 10 * zoom), width))
+        return rect
+
+    def draw_transition(self, surface, transition, geometry=None, color=None):
+        """
+        Draw a transition arrow with its value, which is left out when zoomed out far
+
+        :param surface: the surface to draw to
+        :param transition: the (start, via, end) key of the transition
+        :param geometry: the geometry of the transition, if it is known already
+        :param color: the color to draw it in, instead of the one showing whether it is selected
+        :return: the rect drawn to
+        """
+        if geometry is None:
+            geometry = self.geometry(transition)
+        if color is None:
+            color = (150, 150, 255) if transition == self.selectedT else black
+        rect = draw_transition(surface, geometry, color, self.camera)
+        if self.camera.zoom < labelZoom:
+            return rect
+
+        # Arrow value
+        x, y = self.camera.to_screen(geometry.label)
+        txt, txtrect = render_text(str(transition[1]), regularfont, color)
+        rectc = (x - txtrect.width // 2, y - txtrect.height // 2)
+        background = pygame.Rect(rectc[0]-2, rectc[1]-2, txtrect.w+4, txtrect.h+4)
+        pygame.draw.rect(surface, backgroundColor, background, 0)
+        surface.blit(txt, rectc)
+        return rect.union(background)
+
+    def draw_tests(self, surface):
+        """
+        Draw how many test cases passed, and list the cases, the failing ones first
+
+        :param surface: the surface to draw to
+        :return: the rects drawn to
+        """
+        passed, failed, waiting = self.tests.summary()
+        rects = [text(surface, f"{passed}/{len(self.tests.cases)} passed", (1030, 20), regularfont, black)]
+        if waiting:
+            rects.append(text(surface, f"{waiting} to run", (1030, 45), regularfont, black))
+
+        # The first failing cases, and then the first other ones until the list is full
+        listed = heapq.nsmallest(testRows, self.tests.failing)
+        for position in range(len(self.tests.cases)):
+            if len(listed) >= testRows:
+                break
+            if position not in self.tests.failing:
+                listed.append(position)
+
+        for row, position in enumerate(listed):
+            string, expected = self.tests.cases[position]
+            if string in self.tests.pending:
+                color = testColors["pending"]
+            else:
+                color = testColors["fail"] if position in self.tests.failing else testColors["pass"]
+            line = ("+" if expected == "Accepted" else "-") + (string if string else EPSILON)
+            rects.append(text(surface, line[:20], (1030, 75 + 20 * row), regularfont, color))
+        return rects
+
+    def geometry(self, transition):
+        """
+        Get the geometry of a transition arrow, which is only worked out again
+        once one of its states has moved or its force vector has changed
+
+        :param transition: the (start, via, end) key of the transition
+        :return: the TransitionGeometry of the transition
+        """
+        s, _, e = transition
+        m = self.automaton.transitions[transition]
+        key = (self.automaton.states[s], self.automaton.states[e], m)
+
+        cached = self.geometries.get(transition)
+        if cached is None or cached[0] != key:
+            cached = self.geometries[transition] = (key, TransitionGeometry(*key))
+        return cached[1]
+
+    def hit_grids(self):
+        """
+        Get the grids of the states and transition arrows, which are only rebuilt once the automaton has changed
+
+        :return: the grid of states and the grid of transitions
+        """
+        if self.gridded[0] is not self.automaton or self.gridded[1] != self.automaton.version:
+            states = Grid()
+            for s, (x, y) in self.automaton.states.items():
+                states.insert(s, (x - 30, y - 30, x + 30, y + 30))
+
+            transitions = Grid()
+            # Arrows too flat to be drawn curved are hit as straight ones by their geometry, their force vector is kept
+            for transition in self.automaton.transitions:
+                transitions.insert(transition, self.geometry(transition).box)
+
+            self.grids = (states, transitions)
+            self.gridded = (self.automaton, self.automaton.version)
+        return self.grids
+
+    def snap_index(self):
+        """
+        Get the coordinates of the states other than the selected one, which are only taken again
+        once something else than dragging the selected state changed the automaton
+
+        :return: the CoordinateIndex of the other states
+        """
+        key = (self.automaton, self.selected)
+        if self.snaps is None or self.snaps[0] != key or self.snaps[1] != self.automaton.version:
+            others = CoordinateIndex(pos for label, pos in self.automaton.states.items() if label != self.selected)
+            self.snaps = (key, self.automaton.version, others)
+        return self.snaps[2]
+
+    def typing(self):
+        """
+        Check whether one of the text boxes is being typed in
+
+        :return: True if a text box is active
+        """
+        return self.ui['input'].active or self.ui['filename'].active
+
+    def relabel(self, new_v):
+        """
+        Change the bridging value of the selected transition, unless another transition between
+        the same states already has that value
+
+        :param new_v: the new bridging value
+        """
+        s, v, e = self.selectedT
+        if (s, new_v, e) in self.automaton.transitions:
+            return
+
+        m = self.automaton.transitions[self.selectedT]
+        self.automaton.remove_transition(self.selectedT)
+        self.automaton.add_transition(s, e, new_v, force_vector=m)
+        self.selectedT = (s, new_v, e)
+
+    def add_test(self, expected):
+        """
+        Add the string in the input box as a test case
+
+        :param expected: the result the string should give, "Accepted" or "Declined"
+        """
+        self.tests.add(self.ui['input'].get_text(), expected)
+
+    def load_tests(self):
+        """
+        Add the test cases in the file named in the file name box, with the .tests extension
+        """
+        name = self.ui['filename'].get_text()
+        try:
+            self.tests.load(f"saves/{name}.tests")
+        except FileNotFoundError:
+            self.fileresult = f"No file named {name}.tests"
+        except OSError as e:
+            self.fileresult = f"Could not load {name}.tests: {e.strerror}"
+        except (TestFileError, ValueError) as e:
+            self.fileresult = f"Could not load {name}.tests: {e}"
+        else:
+            self.fileresult = f"Successfully loaded {name}.tests"
 
     def run(self):
         try:
-            steps, (end, result) = self.automaton.run(self.ui['input'].get_text())
+            trace = Trace(self.automaton, self.ui['input'].get_text())
         except StartError:
             self.result = "No Start"
+            self.trace = None
+        else:
+            self.result = trace.result
+            # Keep the steps taken for playing them back, starting paused before the first symbol
+            self.trace = trace
+            self.playing = False
+            self.show_step(0)
+
+    def show_step(self, step):
+        """
+        Show a step of the playback, which stops playing once it reaches the end
+
+        :param step: the number of symbols read
+        """
+        self.step = min(max(step, 0), len(self.trace))
+        if self.step == len(self.trace):
+            self.playing = False
+        self.controls['play'].text = "PAUSE" if self.playing else "PLAY"
+        self.controls['seek'].position = self.step / len(self.trace) if len(self.trace) else 1
+
+    def seek(self, fraction):
+        """
+        Jump to a step of the playback
+
+        :param fraction: how far along the steps to jump to, between 0 and 1
+        """
+        self.show_step(round(fraction * len(self.trace)))
+
+    def step_by(self, steps):
+        """
+        Pause the playback and move a number of steps forward or back
+
+        :param steps: the number of steps, negative to go back
+        """
+        self.playing = False
+        self.show_step(self.step + steps)
+
+    def toggle_play(self):
+        """
+        Play or pause the playback, starting over when it is played at the end
+        """
+        self.playing = not self.playing
+        self.played = time.monotonic()
+        self.show_step(0 if self.playing and self.step == len(self.trace) else self.step)
+
+    def change_speed(self):
+        """
+        Go to the next playback speed, or back to the slowest after the fastest
+        """
+        self.speed = (self.speed + 1) % len(playbackSpeeds)
+        self.played = time.monotonic()
+        self.controls['speed'].text = f"{playbackSpeeds[self.speed]}/s"
+
+    def regex(self):
+        """
+        Replace the automaton with one accepting the strings matching the regular expression in the input box
+        """
+        try:
+            self.automaton = compile_regex(self.ui['input'].get_text())
+        except RegexError:
+            self.result = "Bad Regex"
         else:
-            self.result = result
+            self.selected = None
+            self.selectedT = None
+            self.result = None
+
+    def changed(self):
+        """
+        Check whether the automaton changed since it was last saved or loaded
+
+        :return: True if there are unsaved changes
+        """
+        automaton, version = self.saved
+        return automaton is not self.automaton or version != self.automaton.version
+
+    def submit(self, activity, work, finish, *args):
+        """
+        Run a file job on the worker thread, or queue it until the one still running is done
+
+        :param activity: what the job is doing, shown while it runs
+        :param work: the function to run on the worker thread, with args as arguments
+        :param finish: the function called on the main thread with the future of the job once it is done
+        """
+        if self.job is not None:
+            self.queued.append((activity, work, finish, *args))
+            self.fileresult = f"{activity} once {self.job[2].lower()} is done"
+            return
+        self.progress = 0
+        self.job = (self.files.submit(work, *args), finish, activity)
+
+    def report(self, progress):
+        # Called from the worker thread, which only ever replaces this number
+        self.progress = progress
 
     def save(self):
-        lines = self.automaton.save()
+        saved = (self.automaton, self.automaton.version)
+
+        def finish(future):
+            try:
+                filename = future.result()
+            except OSError as e:
+                self.fileresult = f"Could not save: {e.strerror}"
+            else:
+                self.saved = saved
+                self.fileresult = f"Saved {filename}"
+
+        # The worker writes a snapshot, so editing can go on while it is being saved
+        self.submit("Saving", self.write, finish, self.automaton.copy(), self.ui['filename'].get_text())
 
-        if (filename := self.ui['filename'].get_text()) == "":
-            i = 1
-            while f"untitled{i}.fsa" in os.listdir("saves"):
-                i += 1
-            filename = f"untitled{i}"
+    def write(self, automaton, filename):
+        if filename == "":
+            # Continue counting from the last untitled file, instead of listing every file in 'saves'
+            while os.path.exists(f"saves/untitled{self.untitled}.fsa"):
+                self.untitled += 1
+            filename = f"untitled{self.untitled}"
 
-        f = open(f"saves/{filename}.fsa", "w")
-        for line in lines:
-            f.write(line + "\n")
-        f.close()
+        automaton.save(f"saves/{filename}.fsa", self.report)
+        return f"{filename}.fsa"
+
+    def autosave(self):
+        saved = (self.automaton, self.automaton.version)
+        self.autosaved = time.monotonic()
+
+        def finish(future):
+            try:
+                future.result()
+            except OSError as e:
+                self.fileresult = f"Could not autosave: {e.strerror}"
+            else:
+                self.saved = saved
+
+        self.submit("Autosaving", self.automaton.copy().save, finish, "saves/autosave.fsa", self.report)
 
     def load(self):
-        filename = f"{self.ui['filename'].get_text()}.fsa"
-
-        if filename in os.listdir("saves"):
-            f = open(f"saves/{filename}")
-            lines = f.readlines()
-            f.close()
-            self.fileresult = f"Successfully loaded {filename}.fsa"
-            self.automaton.load(lines)
-        else:
-            self.fileresult = f"No file named {filename}.fsa"
+        name = self.ui['filename'].get_text()
+
+        def finish(future):
+            try:
+                automaton, filename = future.result()
+            except FileNotFoundError:
+                self.fileresult = f"No file named {name}.fsa"
+            except (BinaryFormatError, FSAParseError, OSError, ValueError) as e:
+                self.fileresult = f"Could not load {name}: {e}"
+            else:
+                self.automaton = automaton
+                self.saved = (automaton, automaton.version)
+                self.selected = None
+                self.selectedT = None
+                self.result = None
+                self.fileresult = f"Successfully loaded {filename}"
+
+        self.submit("Loading", self.read, finish, name)
+
+    def read(self, name):
+        automaton = Automaton()
+        # Opening the files directly is cheaper than listing every file in 'saves' to look for them
+        try:
+            automaton.load(f"saves/{name}.fsa", self.report)
+            return automaton, f"{name}.fsa"
+        except FileNotFoundError:
+            automaton.load_binary(f"saves/{name}.fsab")
+            return automaton, f"{name}.fsab"
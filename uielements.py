@@ -1,4 +1,8 @@
+import math
+from collections import OrderedDict
+
 import pygame
+import pygame.gfxdraw
 import scenes
 
 # This module contains elements used by the UI (buttons, etc.)
@@ -11,6 +15,32 @@ regularfont = pygame.freetype.SysFont('Mono', 20)
 biggerfont = pygame.freetype.SysFont('Mono', 40)
 
 
+# Rendered text surfaces and their rects by (font, string, color), most recently used last
+text_cache = OrderedDict()
+text_cache_size = 512
+
+
+def render_text(message, font, color):
+    """
+    Render text, reusing the surface from an earlier call with the same font, string and color.
+    The returned surface and rect are shared, so they must not be changed
+
+    :param message: the text to render
+    :param font: the font to render the text with
+    :param color: the color of the text
+    :return: the surface and rect, like font.render
+    """
+    key = (font, message, color)
+    if key in text_cache:
+        text_cache.move_to_end(key)
+        return text_cache[key]
+
+    rendered = text_cache[key] = font.render(message, color)
+    if len(text_cache) > text_cache_size:
+        text_cache.popitem(last=False)
+    return rendered
+
+
 # Add text to a surface
 def text(surface, message, pos, font, color):
     """
@@ -21,13 +51,152 @@ def text(surface, message, pos, font, color):
     :param pos: the position of the drawing on the surface (topleft)
     :param font: the font to draw the text with
     :param color: the color of the text
+    :return: the rect drawn to
+    """
+    t, _ = render_text(message, font, color)
+    return surface.blit(t, pos)
+
+
+# Draw a (curved) transition arrow with its head, from its precomputed geometry, and return the rect drawn to
+def draw_transition(surface, geometry, color, camera):
+    width = max(1, round(3 * camera.zoom))
+
+    if geometry.curved:
+        outline = geometry.outline(camera.segments(geometry.radius))
+        path = [camera.to_screen(p) for p in visible_part(outline, camera.view(surface.get_clip()))]
+        if len(path) > 2:
+            pygame.gfxdraw.aapolygon(surface, path, color)
+            pygame.gfxdraw.filled_polygon(surface, path, color)
+        left, top = camera.to_screen(geometry.box[:2])
+        right, bottom = camera.to_screen(geometry.box[2:])
+        rect = pygame.Rect(left, top, right - left, bottom - top)
+    else:
+        rect = pygame.draw.line(surface, color, *[camera.to_screen(p) for p in geometry.line], width)
+
+    if camera.zoom < camera.head_zoom:
+        return rect
+    return rect.union(pygame.draw.polygon(surface, color, [camera.to_screen(p) for p in geometry.head], width=0))
+
+
+# Get the part of the outline of a curved arrow near a box, so arrows reaching far out of it aren't filled in
+# all the way, which takes as long as they are high
+def visible_part(outline, box):
+    # The outline goes along the outer edge and back along the inner edge, with a point of each at every step
+    last = len(outline) // 2 - 1
+    margin = math.dist(outline[0], outline[1]) + 3
+    left, top, right, bottom = box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin
+    near = [i for i, (x, y) in enumerate(outline[:last + 1]) if left <= x <= right and top <= y <= bottom]
+
+    if not near:
+        return []
+    first, final = max(near[0] - 1, 0), min(near[-1] + 1, last)
+    if first == 0 and final == last:
+        return outline
+    return outline[first:final + 1] + outline[2 * last + 1 - final:2 * last + 2 - first]
+
+
+class Camera:
+    """
+    Maps positions in the diagram to positions on the screen, where the diagram can be panned and zoomed.
+    The pan is kept in whole pixels, so a panned picture can be reused by scrolling it
+    """
+    min_zoom = 0.02
+    max_zoom = 4
+    # Below this zoom, arrowheads are too small to make out and aren't drawn
+    head_zoom = 0.25
+
+    def __init__(self):
+        self.zoom = 1
+        # The position on the screen where the origin of the diagram would be drawn, negated
+        self.x = 0
+        self.y = 0
+
+    def key(self):
+        return self.x, self.y, self.zoom
+
+    def to_screen(self, pos):
+        return pos[0] * self.zoom - self.x, pos[1] * self.zoom - self.y
+
+    def to_world(self, pos):
+        return (pos[0] + self.x) / self.zoom, (pos[1] + self.y) / self.zoom
+
+    def pan(self, dx, dy):
+        self.x -= dx
+        self.y -= dy
+
+    def zoom_at(self, pos, factor):
+        """
+        Zoom in or out, keeping the point under the given position on the screen in place
+
+        :param pos: the position on the screen
+        :param factor: how many times larger everything should become
+        """
+        x, y = self.to_world(pos)
+        self.zoom = min(max(self.zoom * factor, self.min_zoom), self.max_zoom)
+        self.x = round(x * self.zoom - pos[0])
+        self.y = round(y * self.zoom - pos[1])
+
+    def view(self, rect):
+        """
+        :param rect: a rect on the screen
+        :return: the (left, top, right, bottom) box of the diagram shown in the rect
+        """
+        return (*self.to_world(rect.topleft), *self.to_world(rect.bottomright))
+
+    def segments(self, radius):
+        """
+        Get the number of segments to draw an arc with, which shrinks with the arc on the screen.
+        Numbers are rounded up to powers of two, so arcs don't need a new outline for every step of zooming
+
+        :param radius: the radius of the arc in the diagram
+        :return: the number of segments, or None for as many as at full size
+        """
+        if self.zoom >= 1:
+            return None
+        return 2 ** max(1, math.ceil(math.log2(max(1, radius * self.zoom / 2))))
+
+
+class CachedElement:
+    """
+    A UI element whose rendered surface is kept, and only drawn again once its appearance changes
     """
-    t, _ = font.render(message, color)
-    surface.blit(t, pos)
+    # The last rendered surface, and the appearance it was rendered with
+    surface = None
+    rendered = None
+
+    def appearance(self):
+        """
+        Return everything that decides what the element looks like
+
+        :return: a value that is equal for elements that look the same
+        """
+        raise NotImplementedError
+
+    def draw(self, surface):
+        """
+        Draw the element
+
+        :param surface: the surface to draw to, the size of the element
+        """
+        raise NotImplementedError
+
+    def render(self):
+        """
+        Return a surface containing the rendered element
+
+        :return: the element surface
+        """
+        if self.rendered == (appearance := self.appearance()):
+            return self.surface
+        self.rendered = appearance
+        if self.surface is None or self.surface.get_size() != self.rect.size:
+            self.surface = pygame.Surface(self.rect.size)
+        self.draw(self.surface)
+        return self.surface
 
 
 # Class representing a clickable button
-class Button:
+class Button(CachedElement):
     """
     A button that can be pressed and then executes a function on the given scene
     """
@@ -55,25 +224,19 @@ class Button:
             # Become lighter when no mouse is hovering over button
             self.color = tuple([self.color[i] + 2 if self.color[i] < 220 else self.color[i] for i in range(3)])
 
-    # Draw the button
-    def render(self):
-        """
-        Return a surface containing the rendered button
-
-        :return: the button surface
-        """
-        surface = pygame.Surface(self.rect.size)
+    def appearance(self):
+        return self.text, self.color, self.bordercolor, self.textcolor
 
+    # Draw the button
+    def draw(self, surface):
         # Background and border
         pygame.draw.rect(surface, self.color, pygame.Rect(1, 1, self.rect.width - 2, self.rect.height - 2), 0)
         pygame.draw.rect(surface, self.bordercolor, pygame.Rect(0, 0, self.rect.width - 1, self.rect.height - 1), 2)
 
         # Text
-        txt, rect = regularfont.render(self.text, self.textcolor)
+        txt, rect = render_text(self.text, regularfont, self.textcolor)
         surface.blit(txt, (surface.get_width() // 2 - rect.width // 2, 10))
 
-        return surface
-
     def handle_events(self, events, overridemouse=None):
         mousepos = pygame.mouse.get_pos()
         if overridemouse is not None:
@@ -88,7 +251,46 @@ class Button:
                         self.scene.execute(func, self.args)
 
 
-class TextBox:
+class SeekBar(CachedElement):
+    """
+    A bar showing how far along something is, which can be clicked or dragged along to jump elsewhere,
+    executing a function on the given scene with the chosen fraction
+    """
+    def __init__(self, rect, func, scene):
+        self.rect = rect
+        self.func = func
+        self.scene = scene
+        # How far along the bar is filled, between 0 and 1
+        self.position = 0
+        self.dragging = False
+
+    def appearance(self):
+        return round(self.position * (self.rect.width - 4))
+
+    # Draw the bar
+    def draw(self, surface):
+        # Background, the filled part and the border
+        pygame.draw.rect(surface, (255, 255, 255), pygame.Rect(1, 1, self.rect.width - 2, self.rect.height - 2), 0)
+        pygame.draw.rect(surface, (150, 150, 255), pygame.Rect(2, 2, self.appearance(), self.rect.height - 4), 0)
+        pygame.draw.rect(surface, (20, 20, 20), pygame.Rect(0, 0, self.rect.width - 1, self.rect.height - 1), 2)
+
+    def handle_events(self, events, overridemouse=None):
+        mousepos = pygame.mouse.get_pos()
+        if overridemouse is not None:
+            mousepos = overridemouse
+
+        for event in events:
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.rect.collidepoint(mousepos):
+                self.dragging = True
+            elif event.type == pygame.MOUSEBUTTONUP:
+                self.dragging = False
+
+        if self.dragging:
+            fraction = min(max((mousepos[0] - self.rect.x - 2) / (self.rect.width - 4), 0), 1)
+            self.scene.execute(self.func, [fraction])
+
+
+class TextBox(CachedElement):
     """
     A text box which can be activated by being clicked on, after which text can be written into it
     """
@@ -123,23 +325,19 @@ class TextBox:
         """
         self.text = s
 
-    def render(self):
-        """
-        Return a surface containing the rendered text box
-
-        :return: the text box surface
-        """
-        surface = pygame.Surface(self.rect.size)
+    def appearance(self):
+        return self.text, self.active
 
+    # Draw the text box
+    def draw(self, surface):
         # Background and border
         bordercolor = (180, 140, 255) if self.active else (20, 20, 20)
         pygame.draw.rect(surface, (255, 255, 255), pygame.Rect(1, 1, self.rect.width - 2, self.rect.height - 2), 0)
         pygame.draw.rect(surface, bordercolor, pygame.Rect(0, 0, self.rect.width - 1, self.rect.height - 1), 2)
 
-        # Text
-        text(surface, self.text, (10, 10), regularfont, (0, 0, 0))
-
-        return surface
+        # Text, cut off at what fits in the box, as rendering very long strings is slow
+        fits = max(1, (self.rect.width - 10) // regularfont.get_rect("0").width + 1)
+        text(surface, self.text[:fits], (10, 10), regularfont, (0, 0, 0))
 
     def handle_events(self, events, overridemouse=None):
         mousepos = pygame.mouse.get_pos()